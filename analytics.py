@@ -0,0 +1,168 @@
+import marshal
+import os
+from datetime import datetime, timedelta, timezone
+import utils
+YMD = '%Y-%m-%d'
+ANALYTICS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'analytics.checkpoint')
+# one byte per habit per day. days without a page (the habit wasn't scheduled) are NONE
+NONE = 0
+PROGRESS = 1
+NEUTRAL = 2
+MISSED = 3
+RECENT_DAYS = 30
+TRACKER_PROPERTIES = ['Date', 'Habit (Relation)', 'Cycle', 'Progress', 'Neutral', 'Missed']
+SYNC_OVERLAP = timedelta(minutes=utils.SYNC_OVERLAP_MINUTES)
+
+def get_state(page) -> int:
+    properties = page['properties']
+    if properties.get('Progress', {}).get('checkbox'):
+        return PROGRESS
+    if properties.get('Neutral', {}).get('checkbox'):
+        return NEUTRAL
+    return MISSED
+
+def get_rate(states: bytes) -> float | None:
+    '''
+    share of the days that counted (progress or missed) that were progress. neutral days don't count either way
+    '''
+    progress = states.count(PROGRESS)
+    total = progress + states.count(MISSED)
+    return progress / total if total else None
+
+
+class History:
+    '''
+    the whole habit tracker boiled down to a bytearray of day states per habit, indexed by days since epoch, plus the
+    range of days each cycle spans. it's loaded from notion once, then each sync only applies the pages edited since
+    the last one, and it's kept between runs as a marshal checkpoint
+    '''
+    def __init__(self):
+        self.epoch: datetime = None
+        self.habits: dict[str, bytearray] = {}
+        # first and last day offsets seen for each cycle
+        self.cycles: dict[str, list[int]] = {}
+        self.synced_at: datetime = None
+        # values last written to each habit and cycle page, so unchanged ones aren't sent again
+        self.written: dict[str, list] = {}
+
+    @classmethod
+    def load(cls, path):
+        history = cls()
+        if not os.path.exists(path):
+            return history
+        with open(path, 'rb') as fp:
+            checkpoint = marshal.load(fp)
+        history.epoch = datetime.fromisoformat(checkpoint['epoch']) if checkpoint['epoch'] else None
+        history.habits = {id: bytearray(states) for id, states in checkpoint['habits'].items()}
+        history.cycles = checkpoint['cycles']
+        history.synced_at = datetime.fromisoformat(checkpoint['synced_at']) if checkpoint['synced_at'] else None
+        history.written = checkpoint['written']
+        return history
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as fp:
+            marshal.dump({
+                'epoch': self.epoch.strftime(YMD) if self.epoch else None,
+                'habits': {id: bytes(states) for id, states in self.habits.items()},
+                'cycles': self.cycles,
+                'synced_at': self.synced_at.isoformat() if self.synced_at else None,
+                'written': self.written,
+            }, fp)
+        os.replace(path + '.tmp', path)
+
+    def offset(self, date: str) -> int:
+        day = datetime.fromisoformat(date)
+        if self.epoch is None:
+            self.epoch = day
+        if day < self.epoch:
+            # pages from before the epoch move it back, every array shifts along with it
+            shift = (self.epoch - day).days
+            for states in self.habits.values():
+                states[0:0] = bytes(shift)
+            for span in self.cycles.values():
+                span[0] += shift
+                span[1] += shift
+            self.epoch = day
+        return (day - self.epoch).days
+
+    def set(self, habit_id, date: str, state: int, cycle_id=None):
+        i = self.offset(date)
+        states = self.habits.setdefault(habit_id, bytearray())
+        if len(states) <= i:
+            states.extend(bytes(i + 1 - len(states)))
+        states[i] = state
+        if cycle_id:
+            span = self.cycles.setdefault(cycle_id, [i, i])
+            span[0] = min(span[0], i)
+            span[1] = max(span[1], i)
+
+    def sync(self, bridge: utils.Bridge, db_id) -> int:
+        '''
+        applies every tracker page edited since the last sync, or every page on the first one. returns how many were applied
+        '''
+        now = datetime.now(timezone.utc)
+        body = {}
+        if self.synced_at:
+            # notion rounds last_edited_time down to the minute, re-applying a page is harmless
+            body = {'filter': {'timestamp': 'last_edited_time', 'last_edited_time': {'on_or_after': (self.synced_at - SYNC_OVERLAP).isoformat()}}}
+        applied = 0
+        for page in bridge.stream(db_id, body, filter_properties=TRACKER_PROPERTIES, prefetch=True):
+            date = page['properties']['Date']['date']
+            relation = page['properties']['Habit (Relation)']['relation']
+            if not date or not relation:
+                continue
+            cycle = page['properties'].get('Cycle', {}).get('relation')
+            self.set(relation[0]['id'], date['start'][:10], get_state(page), cycle[0]['id'] if cycle else None)
+            applied += 1
+        self.synced_at = now
+        return applied
+
+    def settled(self, habit_id, today: str) -> bytes:
+        '''
+        the habit's states up to today. pages still ahead are left out, and so is today's until it's checked off,
+        since an unchecked page only counts as missed once its day is over
+        '''
+        states = self.habits.get(habit_id, bytearray())
+        if self.epoch is None:
+            return b''
+        end = (datetime.fromisoformat(today) - self.epoch).days
+        if 0 <= end < len(states) and states[end] == MISSED:
+            end -= 1
+        return bytes(states[:max(end + 1, 0)])
+
+    def streaks(self, habit_id, today: str) -> tuple[int, int]:
+        '''
+        (current, longest) runs of progress days. missed days break a streak, neutral days and days without a page don't
+        '''
+        runs = self.settled(habit_id, today).split(bytes([MISSED]))
+        return runs[-1].count(PROGRESS), max(run.count(PROGRESS) for run in runs)
+
+    def summary(self, today: str) -> dict:
+        '''
+        streaks and completion rates per habit (overall and over the last RECENT_DAYS), and completion rates per cycle
+        '''
+        settled = {habit_id: self.settled(habit_id, today) for habit_id in self.habits}
+        recent_start = max((datetime.fromisoformat(today) - self.epoch).days - RECENT_DAYS + 1, 0) if self.epoch else 0
+        habits = {}
+        for habit_id, states in settled.items():
+            current, longest = self.streaks(habit_id, today)
+            habits[habit_id] = {
+                'current_streak': current,
+                'longest_streak': longest,
+                'completion_rate': get_rate(states),
+                'recent_completion_rate': get_rate(states[recent_start:]),
+                'progress': states.count(PROGRESS),
+                'neutral': states.count(NEUTRAL),
+                'missed': states.count(MISSED),
+            }
+        cycles = {}
+        for cycle_id, (first, last) in self.cycles.items():
+            spans = {habit_id: states[first:last + 1] for habit_id, states in settled.items()}
+            rates = {habit_id: get_rate(span) for habit_id, span in spans.items()}
+            cycles[cycle_id] = {
+                'start': (self.epoch + timedelta(days=first)).strftime(YMD),
+                'end': (self.epoch + timedelta(days=last)).strftime(YMD),
+                'completion_rate': get_rate(b''.join(spans.values())),
+                'habits': {habit_id: rate for habit_id, rate in rates.items() if rate is not None},
+            }
+        return {'habits': habits, 'cycles': cycles}
@@ -0,0 +1,222 @@
+'''
+offline micro-benchmarks for the planning hot paths. nothing here talks to notion: runs use a stubbed bridge.
+
+    python benchmarks.py --out bench.json
+    python benchmarks.py --out new.json --compare bench.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import utils
+from notion import Notion, YMD
+
+CATALOG_SIZES = [10, 100, 1000, 10000]
+RANGE_DAYS = [1, 7, 31, 365]
+QUICK_CATALOG_SIZES = [10, 100]
+QUICK_RANGE_DAYS = [1, 7]
+# end to end runs create catalog x range pages, so the biggest combinations are left out
+MAX_PAGES = 100000
+FREQUENCIES = ['Daily', 'Workday', '1x Week', '2x Week', '3x Week', '4x Week', '5x Week', '6x Week']
+START_DATE = datetime.fromisoformat('2023-01-01')
+
+
+class StubResponse:
+    status_code = 200
+    headers = {}
+    content = b''
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class StubBridge(utils.Bridge):
+    '''
+    a Bridge that answers every request locally: queries come back empty and pages are created instantly
+    '''
+    def __init__(self):
+        super().__init__('secret_benchmark', limiter=utils.RateLimiter(10 ** 9, 10 ** 9))
+        self.pages = 0
+
+    def send(self, method, url, body, endpoint, idempotent=True):
+        if url.endswith('/query') or '/query?' in url:
+            return StubResponse({'results': [], 'has_more': False, 'next_cursor': None})
+        self.pages += 1
+        if isinstance(body, bytes):
+            body = json.loads(body)
+        return StubResponse({'object': 'page', 'id': 'stub-' + str(self.pages), 'properties': body.get('properties', {})})
+
+
+def get_catalog(size) -> list[dict]:
+    '''
+    a synthetic habit catalog mixing every frequency, day overrides and habits that are turned off
+    '''
+    habits = []
+    for i in range(size):
+        habits.append({
+            'name': 'habit ' + str(i),
+            'frequency': FREQUENCIES[i % len(FREQUENCIES)],
+            'id': 'habit-' + str(i),
+            'icon': '🏃' if i % 2 else None,
+            'icon_type': 'emoji' if i % 2 else None,
+            'status': 'Off' if i % 10 == 9 else 'On',
+            'days': 'Monday, Thursday' if i % 7 == 6 else None,
+        })
+    return habits
+
+def get_dates(days) -> list[str]:
+    return [(START_DATE + timedelta(days=i)).strftime(YMD) for i in range(days)]
+
+def get_notion(config_path, habits) -> Notion:
+    notion = Notion(config_path)
+    notion.bridge = notion.generator.bridge = StubBridge()
+    notion.config.habits = habits
+    notion.config.use_ledger = False
+    notion.config.concurrency = 1
+    return notion
+
+def measure(fn, repeat) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'repeat': repeat, 'best_seconds': min(times), 'mean_seconds': sum(times) / len(times)}
+
+
+def bench_filtered_habits(notion, dates):
+    def run():
+        for date in dates:
+            notion.current_habit_datetime = datetime.fromisoformat(date)
+            for _ in notion.get_filtered_habits():
+                pass
+    return run
+
+def bench_plan_habits(notion, dates):
+    def run():
+        for _, habits in notion.plan_habits(dates):
+            for _ in notion.schedule.habits_for(habits):
+                pass
+    return run
+
+def bench_cycle_end_date(notion, dates):
+    def run():
+        for date in dates:
+            notion.current_habit_datetime = datetime.fromisoformat(date)
+            notion.get_cycle_end_date()
+    return run
+
+def bench_date_generators(notion):
+    def run():
+        notion.current_habit_datetime = datetime.now()
+        list(notion.get_month())
+        list(notion.get_dates_til_next_cycle())
+    return run
+
+def bench_payload_dicts(notion, habits, date):
+    def run():
+        for habit in habits:
+            json.dumps(utils.get_page_payload(notion.config.habit_tracker_db_id, notion.get_habit_properties(habit, 'cycle-id', date), habit['icon'], habit['icon_type']))
+    return run
+
+def bench_payload_templates(notion, habits, date):
+    def run():
+        for habit in habits:
+            notion.get_page_template(habit).render(date, 'cycle-id')
+    return run
+
+def bench_startup():
+    '''
+    a fresh interpreter importing the job, which is what every cron launch pays before doing anything
+    '''
+    def run():
+        subprocess.run([sys.executable, '-c', 'import notion'], check=True, cwd=os.path.dirname(os.path.realpath(__file__)))
+    return run
+
+def bench_create_habits(notion, dates):
+    def run():
+        notion.templates = {}
+        notion.create_habits_for_dates(dates)
+    return run
+
+
+def run_benchmarks(catalog_sizes=CATALOG_SIZES, range_days=RANGE_DAYS, repeat=3) -> list[dict]:
+    results = []
+    def record(name, fn, **params):
+        result = {'name': name, 'params': params}
+        result.update(measure(fn, repeat))
+        results.append(result)
+        print(name + ' ' + json.dumps(params) + ': ' + '{:.6f}'.format(result['best_seconds']) + 's')
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as fp:
+            json.dump({'api_key': 'secret_benchmark', 'habit_tracker_db_id': 'tracker', 'cycles_db_id': 'cycles', 'habits_db': 'habits', 'new_cycle_dates': [1, 15], 'job_frequency': '0'}, fp)
+        # the holiday calendar is computed outside of the timings
+        get_notion(config_path, []).get_holidays().prepare([datetime.fromisoformat(date) for date in get_dates(max(range_days))])
+
+        record('startup', bench_startup())
+        notion = get_notion(config_path, [])
+        record('get_cycle_end_date', bench_cycle_end_date(notion, get_dates(max(range_days))), days=max(range_days))
+        record('get_month+get_dates_til_next_cycle', bench_date_generators(notion))
+        for size in catalog_sizes:
+            habits = get_catalog(size)
+            notion = get_notion(config_path, habits)
+            notion.get_holidays().prepare([datetime.fromisoformat(date) for date in get_dates(max(range_days))])
+            record('payload_dicts', bench_payload_dicts(notion, habits, get_dates(1)[0]), habits=size)
+            notion.get_page_template(habits[0])
+            record('payload_templates', bench_payload_templates(notion, habits, get_dates(1)[0]), habits=size)
+            for days in range_days:
+                dates = get_dates(days)
+                record('get_filtered_habits', bench_filtered_habits(notion, dates), habits=size, days=days)
+                record('plan_habits', bench_plan_habits(notion, dates), habits=size, days=days)
+                if size * days <= MAX_PAGES:
+                    record('create_habits_for_dates', bench_create_habits(notion, dates), habits=size, days=days)
+    return results
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline_path):
+    '''
+    prints how each benchmark moved relative to an earlier results file
+    '''
+    with open(baseline_path, 'r') as fp:
+        baseline = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(fp)['results']}
+    for result in results:
+        old = baseline.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if not old:
+            continue
+        ratio = result['best_seconds'] / old['best_seconds'] if old['best_seconds'] else float('inf')
+        print('{:<40} {:<32} {:>10.6f}s -> {:>10.6f}s  x{:.2f}'.format(result['name'], json.dumps(result['params']), old['best_seconds'], result['best_seconds'], ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline benchmarks of habit planning')
+    parser.add_argument('--out', default='bench.json', help='where to write the results')
+    parser.add_argument('--compare', metavar='PATH', help='earlier results to compare against')
+    parser.add_argument('--quick', action='store_true', help='small catalogs and ranges only')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = run_benchmarks(QUICK_CATALOG_SIZES if args.quick else CATALOG_SIZES, QUICK_RANGE_DAYS if args.quick else RANGE_DAYS, args.repeat)
+    with open(args.out, 'w') as fp:
+        json.dump({
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'created_at': datetime.now().isoformat(),
+            'results': results,
+        }, fp, indent=1)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,136 @@
+'''
+record and replay of the requests a Bridge sends, see Bridge.record and Bridge.replay:
+
+    python daily_job.py --record run.cassette.jsonl      a normal run that also writes every response to the cassette
+    python daily_job.py --replay run.cassette.jsonl      the same run again, served entirely from the cassette
+
+a cassette is jsonl: a header line (when and for which day the run was recorded) and then one line per request with
+its response. replays never reach notion, so whole weekly, monthly and cyclic runs can be benchmarked and checked
+offline and at any speed
+'''
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime
+
+CASSETTE_VERSION = 1
+
+def get_key(method, url, data) -> str:
+    '''
+    what a request is looked up by on replay: its method, url and exact body
+    '''
+    return hashlib.sha1(method.encode() + b' ' + url.encode() + b'\n' + (data or b'')).hexdigest()
+
+
+class CassetteResponse:
+    '''
+    a recorded response, enough of a requests.Response for Bridge and its callers
+    '''
+    def __init__(self, status_code, content: bytes, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class RecordingSession:
+    '''
+    sends everything through session and appends each request and its response to the cassette at path.
+    rate limited responses aren't kept, a replay serves the outcome of the retries instead. server errors are, since
+    page creations aren't retried after one (see Bridge.send)
+    '''
+    def __init__(self, session, path, header: dict = None):
+        self.session = session
+        self.headers = session.headers
+        self.lock = threading.Lock()
+        self.fp = open(path, 'w')
+        self.fp.write(json.dumps(dict(header or {}, cassette=CASSETTE_VERSION, recorded_at=datetime.now().isoformat())) + '\n')
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        start = time.monotonic()
+        response = self.session.request(method, url, data=data, timeout=timeout, **kwargs)
+        if response.status_code == 429:
+            return response
+        entry = {
+            'key': get_key(method, url, data),
+            'method': method,
+            'url': url,
+            'request': data.decode() if data else None,
+            'status_code': response.status_code,
+            'response': response.content.decode(),
+            'seconds': round(time.monotonic() - start, 3),
+        }
+        with self.lock:
+            self.fp.write(json.dumps(entry) + '\n')
+        return response
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+        self.session.close()
+
+
+class ReplaySession:
+    '''
+    answers requests from a cassette instead of sending them. a request is matched to a recorded one with the same
+    method, url and body, each recording being served once and in the order they were recorded. queries whose body
+    changed since (one filtering on the time it's sent, for example) fall back to the next unserved query recorded
+    with the same url, and a request repeated more often than it was recorded gets its last response again. writes
+    never fall back, a page created or updated with a different body than recorded means the replay diverged, and
+    it fails rather than answer with some other page. latency seconds are slept before every response to stand in
+    for the network
+    '''
+    def __init__(self, path, latency=0, sleep=time.sleep):
+        self.latency = latency
+        self.sleep = sleep
+        self.headers = {}
+        self.lock = threading.Lock()
+        self.entries = []
+        with open(path, 'r') as fp:
+            self.header = json.loads(fp.readline())
+            for line in fp:
+                if line.strip():
+                    self.entries.append(json.loads(line))
+        self.served = [False] * len(self.entries)
+        self.by_key: dict[str, list[int]] = {}
+        self.by_url: dict[tuple[str, str], list[int]] = {}
+        for i, entry in enumerate(self.entries):
+            self.by_key.setdefault(entry['key'], []).append(i)
+            self.by_url.setdefault((entry['method'], entry['url']), []).append(i)
+
+    def next_unserved(self, candidates: list[int]) -> int | None:
+        while candidates and self.served[candidates[0]]:
+            candidates.pop(0)
+        return candidates[0] if candidates else None
+
+    def find(self, method, url, data) -> dict:
+        key = get_key(method, url, data)
+        with self.lock:
+            i = self.next_unserved(self.by_key.get(key, []))
+            if i is None and url.endswith('/query'):
+                i = self.next_unserved(self.by_url.get((method, url), []))
+            if i is not None:
+                self.served[i] = True
+                return self.entries[i]
+        repeated = [entry for entry in self.entries if entry['key'] == key]
+        if repeated:
+            return repeated[-1]
+        raise Exception('CASSETTE: nothing recorded for ' + method + ' ' + url)
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        entry = self.find(method, url, data)
+        if self.latency:
+            self.sleep(self.latency)
+        return CassetteResponse(entry['status_code'], entry['response'].encode())
+
+    def unserved(self) -> int:
+        '''
+        recorded requests the replay never made
+        '''
+        return self.served.count(False)
+
+    def close(self):
+        pass
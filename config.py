@@ -1,13 +1,83 @@
-import utils
+import utils, ledger
+from analytics import ANALYTICS_PATH
+from retention import RETENTION_PATH
 import json
+import marshal
 import os
-from model import Frequency
+from datetime import datetime, timedelta, timezone
+from model import Frequency, Habit, as_habit, get_json_default
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.json')
+SYNC_OVERLAP = timedelta(minutes=utils.SYNC_OVERLAP_MINUTES)
+DEFAULT_FULL_SYNC_DAYS = 7
+SNAPSHOT_SUFFIX = '.snapshot'
+# what a habit sync changes in the config, everything else in the file is left as the user last saved it
+SYNCED_KEYS = ['habits', 'habits_synced_at', 'habits_full_synced_at']
+
+def load_config(path, snapshot=False) -> dict:
+    '''
+    parses a config file. with snapshot, the parsed config is kept in a marshal file next to it that later loads read
+    instead, for as long as the config's modification time and size are unchanged
+    '''
+    if not snapshot:
+        with open(path, 'r') as fp:
+            return parse_habits(json.load(fp))
+    # stat before reading, so a config edited while we read it never matches the snapshot we write
+    stat = os.stat(path)
+    key = [stat.st_mtime_ns, stat.st_size]
+    try:
+        with open(path + SNAPSHOT_SUFFIX, 'rb') as fp:
+            snapshot_key, config = marshal.load(fp)
+        if snapshot_key == key:
+            return parse_habits(config)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    with open(path, 'r') as fp:
+        config = json.load(fp)
+    write_snapshot(path, config, key)
+    return parse_habits(config)
+
+def parse_habits(config) -> dict:
+    '''
+    swaps the config's habit dicts for Habit records
+    '''
+    if 'habits' in config:
+        config['habits'] = [Habit.from_dict(habit) for habit in config['habits']]
+    return config
+
+def save_config(path, config, snapshot=False):
+    '''
+    writes the config to a temporary file next to path and swaps it in, so a run killed mid-write leaves the old config
+    rather than a truncated one
+    '''
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(config, fp, indent=1, default=get_json_default)
+    os.replace(path + '.tmp', path)
+    if snapshot:
+        stat = os.stat(path)
+        write_snapshot(path, config, [stat.st_mtime_ns, stat.st_size])
+
+def write_snapshot(path, config, key):
+    try:
+        if 'habits' in config:
+            config = dict(config, habits=[as_habit(habit).to_dict() for habit in config['habits']])
+        with open(path + SNAPSHOT_SUFFIX + '.tmp', 'wb') as fp:
+            marshal.dump([key, config], fp)
+        os.replace(path + SNAPSHOT_SUFFIX + '.tmp', path + SNAPSHOT_SUFFIX)
+    except (OSError, ValueError) as e:
+        # the snapshot only saves time, the config itself is fine
+        print('could not write config snapshot: ' + str(e))
 
 class ConfigGenerator:
     headers = {}
     config = {}
     habits = []
-    def __init__(self):
+    def __init__(self, path='./config.json', config=None, bridge=None, snapshot=False):
+        '''
+        config and bridge can be handed over by a caller that already loaded the config (see Notion), the file
+        is then not read again
+        '''
+        self.path = path
+        self.snapshot = snapshot
         self.options = [
             self.configure_api_key,
             self.configure_habit_tracker_db_id,
@@ -17,10 +87,13 @@ class ConfigGenerator:
             self.load_habits,
             self.configure_frequency,
         ]
+        if config is not None:
+            self.config = config
+            self.bridge = bridge
+            return
         try:
-            with open('./config.json', 'r') as fp:
-                self.config = json.load(fp)
-                self.bridge = utils.Bridge(self.config['api_key']) if 'api_key' in self.config else None
+            self.config = load_config(self.path)
+            self.bridge = utils.Bridge(self.config['api_key']) if 'api_key' in self.config else None
         except Exception as e:
             pass
         
@@ -36,8 +109,22 @@ class ConfigGenerator:
         self.done()
         
     def done(self):
-        with open('./config.json', 'w') as fp:
-            json.dump(self.config, fp, indent=1)
+        save_config(self.path, self.config, self.snapshot)
+
+    def save_habits(self):
+        '''
+        writes the synced habits and sync cursors back to the config file. the file is read again first and only
+        SYNCED_KEYS are replaced, so edits made to it since it was loaded (by hand while the daemon runs, for example)
+        are kept
+        '''
+        try:
+            config = load_config(self.path)
+        except FileNotFoundError:
+            config = {}
+        for key in SYNCED_KEYS:
+            if key in self.config:
+                config[key] = self.config[key]
+        save_config(self.path, config, self.snapshot)
         
     def with_config_setup(self):
         print('looks like you already have a config setup. Would you like to start fresh or correct some details?')
@@ -127,33 +214,79 @@ class ConfigGenerator:
         
     def load_habits(self):
         self.config['habits'] = []
-        if not self.habits:
+        habits = self.habits
+        if not habits:
             if 'habits_db' not in self.config or not self.config['habits_db']:
                 print('you don\'t currently have any habits loaded and don\'t have your daily habits db ID stored. Please add your Habits DB ID and try again')
-            try:
-                resp = self.bridge.query(self.config['habits_db'], {})
-            except Exception as e:
-                print('error getting habits: ')
-                print(e)
-                return
-            self.habits = resp.json()['results']
-        for habit in self.habits:
-            if not habit['properties']['Frequency']['select'] or 'name' not in habit['properties']['Frequency']['select']:
-                if not ('Days' in habit['properties'] and habit['properties']['Days']['rich_text']):
-                    print('one or more of your habits is missing a frequency. Please update accordingly.')
-                    exit(0)
-                habit['properties']['Frequency']['select'] = {
-                    'name': None
-                }
-            self.config['habits'].append({
-                'name': habit['properties']['Name']['title'][0]['plain_text'],
-                'frequency': habit['properties']['Frequency']['select']['name'],
-                'id': habit['id'],
-                'icon': utils.get_icon(habit),
-                'icon_type': utils.get_icon_type(habit),
-                'status': habit['properties']['Status']['select']['name'],
-                'days': habit['properties']['Days']['rich_text'][0]['text']['content'] if 'Days' in habit['properties'] and habit['properties']['Days']['rich_text'] else None,
-            })
+        try:
+            # streamed page by page so we never hold more than one page of raw habit objects
+            for habit in habits or self.bridge.stream(self.config['habits_db'], {}, prefetch=True):
+                self.add_habit(habit)
+        except Exception as e:
+            print('error getting habits: ')
+            print(e)
+            self.config['habits'] = []
+            return False
+        self.config['habits_full_synced_at'] = self.config['habits_synced_at'] = datetime.now(timezone.utc).isoformat()
+        return True
+
+    def sync_habits(self, ttl=None, full_sync_days=DEFAULT_FULL_SYNC_DAYS):
+        '''
+        brings the cached habits in config['habits'] up to date with the habits db. only pages edited since the last sync
+        are queried and merged into the cache, a full load happens on the first sync and every full_sync_days after that
+        (which is also when deleted habits drop out). a cache synced less than ttl seconds ago is used as is.
+        if notion can't be reached the cached habits are kept and the next sync picks up from the same point
+        '''
+        now = datetime.now(timezone.utc)
+        synced_at = datetime.fromisoformat(self.config['habits_synced_at']) if self.config.get('habits_synced_at') else None
+        full_synced_at = datetime.fromisoformat(self.config['habits_full_synced_at']) if self.config.get('habits_full_synced_at') else None
+        if 'habits' not in self.config or not synced_at or not full_synced_at or now - full_synced_at > timedelta(days=full_sync_days):
+            cached = self.config.get('habits', [])
+            if not self.load_habits():
+                self.config['habits'] = cached
+            return
+        if ttl is not None and now - synced_at < timedelta(seconds=ttl):
+            return
+        habits = {habit['id']: habit for habit in self.config['habits']}
+        try:
+            for page in self.bridge.stream(self.config['habits_db'], {
+                'filter': {
+                    'timestamp': 'last_edited_time',
+                    'last_edited_time': {'on_or_after': (synced_at - SYNC_OVERLAP).isoformat()},
+                },
+            }):
+                if page.get('archived') or page.get('in_trash'):
+                    habits.pop(page['id'], None)
+                else:
+                    habits[page['id']] = self.get_habit(page)
+        except Exception as e:
+            print('error syncing habits, using the cached ones: ')
+            print(e)
+            return
+        # dicts keep insertion order, so edited habits stay where they were and new ones go last
+        self.config['habits'] = list(habits.values())
+        self.config['habits_synced_at'] = now.isoformat()
+
+    def add_habit(self, habit):
+        self.config['habits'].append(self.get_habit(habit))
+
+    def get_habit(self, habit) -> Habit:
+        if not habit['properties']['Frequency']['select'] or 'name' not in habit['properties']['Frequency']['select']:
+            if not ('Days' in habit['properties'] and habit['properties']['Days']['rich_text']):
+                print('one or more of your habits is missing a frequency. Please update accordingly.')
+                exit(0)
+            habit['properties']['Frequency']['select'] = {
+                'name': None
+            }
+        return Habit(**{
+            'name': habit['properties']['Name']['title'][0]['plain_text'],
+            'frequency': habit['properties']['Frequency']['select']['name'],
+            'id': habit['id'],
+            'icon': utils.get_icon(habit),
+            'icon_type': utils.get_icon_type(habit),
+            'status': habit['properties']['Status']['select']['name'],
+            'days': habit['properties']['Days']['rich_text'][0]['text']['content'] if 'Days' in habit['properties'] and habit['properties']['Days']['rich_text'] else None,
+        })
     
     def test_db(self, db_id):
         r = self.bridge.query(db_id, {})
@@ -172,13 +305,53 @@ class ConfigObject:
     habit_tracker_db_id = ''
     habits_db = ''
     job_frequency: Frequency = '0'
-    def __init__(self):
+    # http transport tuning, all optional in config.json
+    pool_size = utils.DEFAULT_POOL_SIZE
+    connect_timeout = utils.DEFAULT_CONNECT_TIMEOUT
+    read_timeout = utils.DEFAULT_READ_TIMEOUT
+    # max habit pages in flight at once for weekly/monthly runs, 1 keeps everything sequential
+    concurrency = utils.DEFAULT_CONCURRENCY
+    # token bucket shared by every run using the same api key
+    requests_per_second = utils.DEFAULT_REQUESTS_PER_SECOND
+    burst = utils.DEFAULT_BURST
+    # holidays Workday habits skip, see https://github.com/vacanza/python-holidays for supported codes
+    holiday_country = 'US'
+    holiday_subdiv = None
+    # local record of created pages so reruns only send what's missing
+    use_ledger = True
+    ledger_path = ledger.LEDGER_PATH
+    ledger_retention_days = 90
+    # Progress, Neutral and Setback Notes are sent with their default values unless this is turned off
+    include_default_properties = True
+    # directory the end of run json report and prometheus textfile are written to, nothing is written if unset
+    metrics_dir = None
+    # names this config in metrics when several run side by side (see fleet.py)
+    tenant = None
+    # habits are synced incrementally every run, a catalog synced less than habits_ttl seconds ago isn't checked at all
+    habits_ttl = None
+    habits_full_sync_days = DEFAULT_FULL_SYNC_DAYS
+    # streaks and completion rates kept up to date from the tracker at the end of every run, optionally written back
+    # to Current Streak, Longest Streak and Completion Rate number properties on habit pages (Completion Rate on cycles)
+    analytics = False
+    analytics_write_back = False
+    analytics_path = ANALYTICS_PATH
+    # IANA timezone (ex: "Europe/Paris") whose dates the job works in, the host's when unset
+    timezone = None
+    # tracker pages older than this many days are archived by the retention job (daily_job.py --retention)
+    tracker_retention_days = 365
+    retention_path = RETENTION_PATH
+    def __init__(self, path=CONFIG_PATH, snapshot=False):
         try:
-            my_file = os.path.realpath(__file__)
-            with open(my_file[0:-9] + 'config.json', 'r') as fp:
-                self.config = json.load(fp)
-                for key in self.config:
-                    setattr(self, key, self.config[key])
+            self.config = load_config(path, snapshot)
+            for key in self.config:
+                setattr(self, key, self.config[key])
+            # configs kept elsewhere get their own ledger next to them rather than sharing the default one
+            if 'ledger_path' not in self.config and path != CONFIG_PATH:
+                self.ledger_path = os.path.splitext(path)[0] + '.ledger.sqlite3'
+            if 'analytics_path' not in self.config and path != CONFIG_PATH:
+                self.analytics_path = os.path.splitext(path)[0] + '.analytics'
+            if 'retention_path' not in self.config and path != CONFIG_PATH:
+                self.retention_path = os.path.splitext(path)[0] + '.retention'
         except Exception as e:
             print('error encountered creating conf obj')
             raise e
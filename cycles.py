@@ -0,0 +1,157 @@
+from bisect import bisect_right, insort
+from datetime import datetime
+import utils
+
+# cycles in these states are never looked up again, so they aren't kept in the index
+CLOSED_STATES = ['Archive', 'Error']
+# months of cycle boundaries worked out at a time, starting the month before the first date looked up
+HORIZON_MONTHS = 24
+
+def get_start(cycle) -> str:
+    return cycle['properties']['Date Range']['date']['start']
+
+def get_end(cycle) -> str | None:
+    return cycle['properties']['Date Range']['date']['end']
+
+def get_status(cycle) -> str | None:
+    select = cycle['properties']['Status']['select']
+    return select['name'] if select else None
+
+
+class CycleIndex:
+    '''
+    every open (not archived or errored) cycle, sorted by start date so the cycle containing a date is found by bisect.
+    loaded with a single query per run; cycles created or updated during the run are folded back in with add and set_status
+    '''
+    def __init__(self, cycles=()):
+        self.cycles = {}
+        self.starts = []
+        # states of the closed cycles seen, so they aren't closed again
+        self.closed: dict[str, str] = {}
+        for cycle in cycles:
+            self.add(cycle)
+
+    @classmethod
+    def load(cls, bridge: utils.Bridge, cycles_db_id):
+        return cls(bridge.stream(cycles_db_id, {
+            'filter': {
+                'and': [
+                    {
+                        'property': 'Status',
+                        'select': {
+                            'does_not_equal': state,
+                        }
+                    } for state in CLOSED_STATES
+                ]
+            }
+        }))
+
+    def __len__(self):
+        return len(self.cycles)
+
+    def add(self, cycle):
+        '''
+        inserts or replaces a cycle. closed cycles are dropped from the index
+        '''
+        self.remove(cycle['id'])
+        if get_status(cycle) in CLOSED_STATES:
+            self.closed[cycle['id']] = get_status(cycle)
+            return
+        self.cycles[cycle['id']] = cycle
+        insort(self.starts, (get_start(cycle), cycle['id']))
+
+    def remove(self, id):
+        cycle = self.cycles.pop(id, None)
+        if cycle:
+            self.starts.remove((get_start(cycle), id))
+
+    def status(self, id) -> str | None:
+        '''
+        the cycle's state, None for cycles the index has never seen
+        '''
+        cycle = self.cycles.get(id)
+        return get_status(cycle) if cycle else self.closed.get(id)
+
+    def set_status(self, id, state):
+        cycle = self.cycles.get(id)
+        if not cycle:
+            return
+        cycle['properties']['Status']['select'] = {'name': state}
+        self.add(cycle)
+
+    def containing(self, date: str):
+        '''
+        the cycle whose date range contains date (start inclusive, end exclusive), or None.
+        open cycles shouldn't overlap, so the nearest start at or before date is almost always the answer
+        '''
+        i = bisect_right(self.starts, (date, '\uffff'))
+        while i > 0:
+            i -= 1
+            cycle = self.cycles[self.starts[i][1]]
+            end = get_end(cycle)
+            if end and end > date:
+                return cycle
+        return None
+
+    def find(self, start: str, end: str | None):
+        '''
+        the open cycle spanning exactly start to end, or None
+        '''
+        i = bisect_right(self.starts, (start, ''))
+        while i < len(self.starts) and self.starts[i][0] == start:
+            cycle = self.cycles[self.starts[i][1]]
+            if get_end(cycle) == end:
+                return cycle
+            i += 1
+        return None
+
+    def active(self):
+        return next((self.cycles[id] for _, id in self.starts if get_status(self.cycles[id]) == 'Active'), None)
+
+    def upcoming(self) -> list:
+        return [self.cycles[id] for _, id in self.starts if get_status(self.cycles[id]) == 'Upcoming']
+
+
+class CycleCalendar:
+    '''
+    every cycle boundary (a new_cycle_dates day of some month) over HORIZON_MONTHS, worked out once so the cycle
+    containing a date is found by bisect. dates outside of the horizon move it
+    '''
+    def __init__(self, new_cycle_dates: list[int]):
+        if not new_cycle_dates:
+            raise Exception('new_cycle_dates has to be set to work out cycles')
+        self.new_cycle_dates = new_cycle_dates
+        self.days = sorted(set(new_cycle_dates))
+        self.boundaries: list[datetime] = []
+        # index in days of each boundary's day, the part of the month the cycle ending there is named after
+        self.parts: list[int] = []
+
+    def build(self, date: datetime):
+        year, month = (date.year - 1, 12) if date.month == 1 else (date.year, date.month - 1)
+        self.boundaries = []
+        self.parts = []
+        for _ in range(HORIZON_MONTHS + 2):
+            for part, day in enumerate(self.days):
+                self.boundaries.append(datetime(year, month, day))
+                self.parts.append(part)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def containing(self, date: datetime) -> tuple[datetime, datetime, int]:
+        '''
+        (start, end, index in the sorted new_cycle_dates of the end's day) of the cycle containing date, ends being exclusive
+        '''
+        day = datetime(date.year, date.month, date.day)
+        i = bisect_right(self.boundaries, day) - 1
+        if i < 0 or i + 1 >= len(self.boundaries):
+            self.build(day)
+            i = bisect_right(self.boundaries, day) - 1
+        return self.boundaries[i], self.boundaries[i + 1], self.parts[i + 1]
+
+    def periods(self, start: datetime, end: datetime) -> list[tuple[datetime, datetime, int]]:
+        '''
+        every cycle overlapping start to end inclusive, as given by containing
+        '''
+        periods = [self.containing(start)]
+        while periods[-1][1] <= end:
+            periods.append(self.containing(periods[-1][1]))
+        return periods
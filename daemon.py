@@ -0,0 +1,149 @@
+'''
+runs the job for one or more configs from a single long running process instead of a cron launch per run:
+
+    python daemon.py config.json [other.json ...]
+    python daemon.py configs/             every *.json config in the directory
+
+each config fires at midnight in its own timezone (its "timezone" key, otherwise the host's) on the days its
+job_frequency runs: every day, mondays, the first of the month, or its new_cycle_dates. configs, habits and pooled
+connections stay loaded between runs, so edits to a config file need a restart (syncing habits only rewrites the habits
+in the file, so the edits aren't lost in the meantime). fires missed while the daemon was down
+are caught up oldest first when it starts again, going back at most MAX_CATCH_UP_DAYS
+'''
+import argparse
+import heapq
+import json
+import os
+import time
+import traceback
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+import fleet
+from metrics import Metrics
+from model import Frequency
+from notion import Notion
+
+STATE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'daemon_state.json')
+MAX_CATCH_UP_DAYS = 7
+# the longest single sleep, so a host waking from suspend or a changed clock is noticed within a minute
+MAX_SLEEP = 60
+
+def is_due(config, day: date) -> bool:
+    if config.job_frequency == Frequency.Weekly.value:
+        return day.weekday() == 0
+    if config.job_frequency == Frequency.Monthly.value:
+        return day.day == 1
+    if config.job_frequency == Frequency.Cyclic.value:
+        return day.day in config.new_cycle_dates
+    return True
+
+def get_fire_time(day: date, tz=None) -> float:
+    '''
+    unix time of the midnight starting day in tz, the host's timezone when tz is None
+    '''
+    midnight = datetime.combine(day, datetime.min.time())
+    return (midnight.replace(tzinfo=ZoneInfo(tz)) if tz else midnight.astimezone()).timestamp()
+
+def get_local_date(timestamp, tz=None) -> date:
+    return datetime.fromtimestamp(timestamp, ZoneInfo(tz) if tz else None).date()
+
+
+class Daemon:
+    '''
+    keeps the next fire of every config in a heap ordered by unix time, so configs in different timezones
+    interleave correctly, and runs them as they come due. the last day each config ran for is kept in state_path
+    '''
+    def __init__(self, notions: dict[str, Notion], state_path=STATE_PATH, clock=time.time, sleep=time.sleep):
+        self.notions = notions
+        self.state_path = state_path
+        self.clock = clock
+        self.sleep = sleep
+        self.heap: list[tuple[float, str, str]] = []
+        self.state: dict[str, str] = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as fp:
+                self.state = json.load(fp)
+
+    def schedule(self, path, day: date):
+        heapq.heappush(self.heap, (get_fire_time(day, self.notions[path].config.timezone), day.isoformat(), path))
+
+    def schedule_next(self, path, after: date):
+        '''
+        queues the config's first due day after after. a year without one means it never fires
+        '''
+        config = self.notions[path].config
+        for i in range(1, 367):
+            if is_due(config, after + timedelta(days=i)):
+                self.schedule(path, after + timedelta(days=i))
+                return
+
+    def start(self):
+        '''
+        queues every fire missed since each config last ran, then its next one
+        '''
+        for path, notion in self.notions.items():
+            today = get_local_date(self.clock(), notion.config.timezone)
+            day = today
+            if path in self.state:
+                day = max(date.fromisoformat(self.state[path]) + timedelta(days=1), today - timedelta(days=MAX_CATCH_UP_DAYS))
+            while day <= today:
+                if is_due(notion.config, day):
+                    self.schedule(path, day)
+                day += timedelta(days=1)
+            self.schedule_next(path, today)
+
+    def run_due(self):
+        while self.heap and self.heap[0][0] <= self.clock():
+            _, day, path = heapq.heappop(self.heap)
+            self.fire(path, date.fromisoformat(day))
+            # a config being caught up already has its later fires queued
+            if not any(entry[2] == path for entry in self.heap):
+                self.schedule_next(path, date.fromisoformat(day))
+
+    def fire(self, path, day: date) -> bool:
+        notion = self.notions[path]
+        # every run reports its own metrics
+        notion.metrics = notion.bridge.metrics = Metrics()
+        notion.run_date = datetime.combine(day, datetime.min.time())
+        print(fleet.get_tenant(path) + ': running for ' + day.isoformat())
+        try:
+            notion.run(keep_open=True)
+        except (Exception, SystemExit):
+            # load_habits exits on a bad habit, which shouldn't stop the other configs
+            print(fleet.get_tenant(path) + ': run for ' + day.isoformat() + ' failed')
+            traceback.print_exc()
+            return False
+        finally:
+            notion.run_date = None
+        if self.state.get(path, '') < day.isoformat():
+            self.state[path] = day.isoformat()
+            self.save_state()
+        return True
+
+    def save_state(self):
+        with open(self.state_path + '.tmp', 'w') as fp:
+            json.dump(self.state, fp, indent=1)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self.heap:
+                self.run_due()
+                if self.heap:
+                    self.sleep(min(MAX_SLEEP, max(0, self.heap[0][0] - self.clock())))
+        finally:
+            for notion in self.notions.values():
+                notion.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='creates habits for every config at its own local midnight')
+    parser.add_argument('targets', nargs='+', help='configs, or directories of configs')
+    parser.add_argument('--state', default=STATE_PATH, help='where to keep the last day each config ran for')
+    args = parser.parse_args()
+
+    paths = []
+    for target in args.targets:
+        paths += fleet.get_config_paths(target) if os.path.isdir(target) else [os.path.realpath(target)]
+    Daemon({path: Notion(path) for path in paths}, args.state).serve_forever()
@@ -1,5 +1,66 @@
-
+import argparse
+from contextlib import nullcontext
 from notion import Notion
-n = Notion()
-n.run()
-print('done')
\ No newline at end of file
+
+parser = argparse.ArgumentParser(description='creates your habits for the period set in your config')
+parser.add_argument('--plan', metavar='PATH', help='write everything the run would create to PATH (jsonl) without creating it')
+parser.add_argument('--execute', metavar='PATH', help='create everything in a plan written with --plan')
+parser.add_argument('--backfill', nargs=2, metavar=('START', 'END'), help='create every cycle and habit page from START to END (YYYY-MM-DD, inclusive) that doesn\'t exist yet')
+parser.add_argument('--audit', nargs=2, metavar=('START', 'END'), help='report duplicate and missing habit pages from START to END (YYYY-MM-DD, inclusive)')
+parser.add_argument('--fix', action='store_true', help='with --audit, archive duplicate pages and create missing ones')
+parser.add_argument('--analytics', action='store_true', help='print streaks and completion rates for every habit')
+parser.add_argument('--snapshot', action='store_true', help='read the config through a parsed snapshot kept next to it, refreshed whenever the config changes')
+parser.add_argument('--profile', metavar='DIR', help='profile the run and write the results to DIR (see profiling.py)')
+parser.add_argument('--profile-mode', default='full', choices=['full', 'sample'], help='full: cProfile, tracemalloc and stack samples. sample: stack samples only, cheap enough for production runs')
+parser.add_argument('--profile-rate', type=float, default=1, help='the fraction of runs that get profiled, ex: 0.05')
+parser.add_argument('--retention', action='store_true', help='archive tracker pages older than tracker_retention_days (365 by default)')
+parser.add_argument('--retention-days', type=int, metavar='DAYS', help='with --retention, archive pages older than DAYS instead')
+parser.add_argument('--archived-cycles', action='store_true', help='with --retention, also archive every page of an archived cycle')
+parser.add_argument('--export', metavar='PATH', help='with --retention, append every page to PATH (jsonl) before archiving it')
+parser.add_argument('--record', metavar='PATH', help='also write every response notion sends to a cassette at PATH (see cassette.py)')
+parser.add_argument('--replay', metavar='PATH', help='rerun a recorded run from its cassette at PATH, without reaching notion')
+parser.add_argument('--replay-latency', type=float, default=0, metavar='SECONDS', help='with --replay, simulated network time per request')
+args = parser.parse_args()
+
+profiler = nullcontext()
+if args.profile:
+    import profiling
+    if profiling.sampled(args.profile_rate):
+        profiler = profiling.Profiler(args.profile, args.profile_mode)
+
+n = Notion(snapshot=args.snapshot)
+if args.record:
+    n.use_cassette(args.record, 'record')
+elif args.replay:
+    n.use_cassette(args.replay, 'replay', args.replay_latency)
+with profiler:
+    if args.plan:
+        n.plan(args.plan)
+    elif args.execute:
+        n.execute_plan(args.execute)
+    elif args.backfill:
+        n.backfill(*args.backfill)
+    elif args.analytics:
+        try:
+            summary = n.update_analytics()
+        finally:
+            n.close()
+        names = {habit['id']: habit['name'] for habit in n.config.habits}
+        for habit_id, stats in summary['habits'].items():
+            rate = stats['completion_rate']
+            print((names.get(habit_id) or habit_id) + ': ' + str(stats['current_streak']) + ' day streak (best ' + str(stats['longest_streak']) + '), ' + ('{:.0%}'.format(rate) if rate is not None else '-') + ' completed')
+    elif args.audit:
+        report = n.audit(*args.audit, fix=args.fix)
+        for entry in report['duplicates']:
+            print('duplicate: ' + entry['habit'] + ' on ' + entry['date'] + ', ' + str(len(entry['extra'])) + ' extra page(s)' + (' archived' if args.fix else ''))
+        for entry in report['missing']:
+            print('missing: ' + entry['habit'] + ' on ' + entry['date'] + (' (created)' if args.fix else ''))
+        for entry in report['unexpected']:
+            print('unscheduled: ' + (entry['habit'] or entry['habit_id']) + ' on ' + entry['date'])
+        print(str(len(report['duplicates'])) + ' duplicated, ' + str(len(report['missing'])) + ' missing, ' + str(len(report['unexpected'])) + ' unscheduled')
+    elif args.retention:
+        report = n.retain(args.retention_days, args.archived_cycles, args.export)
+        print(str(report['found']) + ' pages found, ' + str(report['exported']) + ' exported, ' + str(report['archived']) + ' archived, ' + str(report['failed']) + ' failed' + (' (rerun to retry them)' if report['failed'] else ''))
+    else:
+        n.run()
+print('done')
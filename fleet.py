@@ -0,0 +1,94 @@
+'''
+runs the daily job for many configs in one process:
+
+    python fleet.py configs/              every *.json config in the directory
+    python fleet.py manifest.json         a json list of config paths, or {"configs": [...]}, relative to the manifest
+
+tenants run on a worker pool. each integration token keeps its own rate limit (see utils.RateLimiter.shared), so a slow
+or broken workspace only holds up its own worker, and the fleet gives up on anything still running after --timeout seconds
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from notion import Notion
+
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 30 * 60
+
+def get_config_paths(target) -> list[str]:
+    if os.path.isdir(target):
+        return sorted(os.path.join(target, name) for name in os.listdir(target) if name.endswith('.json'))
+    with open(target, 'r') as fp:
+        manifest = json.load(fp)
+    paths = manifest['configs'] if isinstance(manifest, dict) else manifest
+    root = os.path.dirname(os.path.realpath(target))
+    return [os.path.join(root, path) for path in paths]
+
+def get_tenant(path) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+def run_tenant(path) -> dict:
+    '''
+    one tenant's run. its metrics are labelled with the tenant, which defaults to the config's file name
+    '''
+    notion = Notion(path)
+    notion.config.tenant = notion.config.tenant or get_tenant(path)
+    notion.run()
+    return notion.bridge.stats()
+
+def run_fleet(paths, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, runner=run_tenant) -> list[dict]:
+    '''
+    runs every config and reports how each went. configs still running when timeout runs out are reported as timed out,
+    and ones that never got a worker are cancelled
+    '''
+    results = {path: {'tenant': get_tenant(path), 'config': path, 'status': 'timed out'} for path in paths}
+    started = {}
+    def run(path):
+        started[path] = time.monotonic()
+        try:
+            results[path]['stats'] = runner(path)
+            results[path]['status'] = 'ok'
+        except BaseException as e:
+            # load_habits exits on a bad habit, which shouldn't take the rest of the fleet down with it
+            results[path]['status'] = 'failed'
+            results[path]['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        finally:
+            results[path]['seconds'] = time.monotonic() - started[path]
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tenant')
+    futures = [executor.submit(run, path) for path in paths]
+    wait(futures, timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+    report = []
+    for path in paths:
+        # copied, a timed out tenant may still finish after we stop waiting on it
+        result = dict(results[path])
+        if path not in started:
+            result['status'] = 'cancelled'
+        elif 'seconds' not in result:
+            result['seconds'] = time.monotonic() - started[path]
+        report.append(result)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='runs the daily job for every config in a directory or manifest')
+    parser.add_argument('target', help='a directory of configs or a manifest listing them')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='tenants run at the same time')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='seconds before the fleet stops waiting on slow tenants')
+    parser.add_argument('--report', metavar='PATH', help='write per tenant results to PATH as json')
+    args = parser.parse_args()
+
+    results = run_fleet(get_config_paths(args.target), args.workers, args.timeout)
+    for result in results:
+        print(result['tenant'] + ': ' + result['status'] + (' - ' + result['error'] if 'error' in result else ''))
+    if args.report:
+        with open(args.report, 'w') as fp:
+            json.dump(results, fp, indent=1)
+    sys.stdout.flush()
+    # threads stuck on a timed out tenant can't be stopped, so don't wait on them to exit
+    os._exit(0 if all(result['status'] == 'ok' for result in results) else 1)
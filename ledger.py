@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+YMD = '%Y-%m-%d'
+LEDGER_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ledger.sqlite3')
+PENDING = 'pending'
+DONE = 'done'
+# vacuuming is only worth it once a compaction has actually freed a meaningful number of rows
+VACUUM_THRESHOLD = 1000
+# seconds to wait on another process (another fleet worker, a second cron fire) writing to the same ledger
+LOCK_TIMEOUT = 30
+
+
+class Ledger:
+    '''
+    local record of the habit pages this job has created, keyed by (habit id, date, tracker db id).
+    pages are journaled as pending before they're sent and marked done with their page id once notion accepts them,
+    so a rerun after a crash or a double cron fire knows which pages already exist without asking notion.
+    a page left pending (we died between sending and hearing back) is treated as missing and sent again
+    '''
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        # pages are marked done from the async path's worker threads, all access is serialized by self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=LOCK_TIMEOUT)
+        if path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                habit_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                db_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                page_id TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (db_id, date, habit_id)
+            ) WITHOUT ROWID
+        ''')
+
+    def created(self, db_id, dates) -> dict[str, set[str]]:
+        '''
+        ids of the habits with a page already created for each of dates, keyed by date
+        '''
+        dates = list(dates)
+        created = {date: set() for date in dates}
+        if not dates:
+            return created
+        with self.lock:
+            rows = self.connection.execute('SELECT date, habit_id FROM pages WHERE db_id = ? AND status = ? AND date BETWEEN ? AND ?', (db_id, DONE, min(dates), max(dates))).fetchall()
+        for date, habit_id in rows:
+            if date in created:
+                created[date].add(habit_id)
+        return created
+
+    def journal(self, db_id, date, habit_ids):
+        '''
+        records pages we're about to send. never downgrades a page that's already done
+        '''
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR IGNORE INTO pages (habit_id, date, db_id, status, updated_at) VALUES (?, ?, ?, ?, ?)', [(habit_id, date, db_id, PENDING, now) for habit_id in habit_ids])
+            self.connection.execute('COMMIT')
+
+    def mark_done(self, db_id, date, habit_id, page_id):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO pages (habit_id, date, db_id, status, page_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)', (habit_id, date, db_id, DONE, page_id, time.time()))
+
+    def compact(self, retention_days) -> int:
+        '''
+        forgets pages dated more than retention_days ago, no run will ever plan them again. returns the number of rows removed
+        '''
+        cutoff = (datetime.now() - timedelta(days=retention_days)).strftime(YMD)
+        with self.lock:
+            removed = self.connection.execute('DELETE FROM pages WHERE date < ?', (cutoff,)).rowcount
+            if removed >= VACUUM_THRESHOLD:
+                self.connection.execute('VACUUM')
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the request latency histogram buckets, notion calls usually take a few hundred ms
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+PROMETHEUS_PREFIX = 'notion_habits_'
+
+
+class Histogram:
+    '''
+    latency histogram with fixed buckets, observations above the last bucket land in an overflow bucket
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q) -> float | None:
+        '''
+        the upper bound of the bucket holding the q-th quantile, which is what an alert on p95 compares against
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class Metrics:
+    '''
+    counters, latency histograms and phase timings for one run. the bridge records every request it sends, Notion.run
+    times its phases, and the whole thing is written out as a json report and a prometheus textfile at the end of the run
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests: dict[tuple[str, str], int] = {}
+        self.latency: dict[str, Histogram] = {}
+        self.retries: dict[str, int] = {}
+        self.bytes_sent: dict[str, int] = {}
+        self.bytes_received: dict[str, int] = {}
+        self.phases: dict[str, float] = {}
+        self.throttled_seconds = 0
+        self.network_seconds = 0
+
+    def observe_request(self, endpoint, status, seconds, sent, received):
+        '''
+        status is the response's status code, or "error" when no response came back at all
+        '''
+        with self.lock:
+            key = (endpoint, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault(endpoint, Histogram()).observe(seconds)
+            self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + sent
+            self.bytes_received[endpoint] = self.bytes_received.get(endpoint, 0) + received
+            self.network_seconds += seconds
+
+    def observe_retry(self, endpoint):
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def observe_throttle(self, seconds):
+        with self.lock:
+            self.throttled_seconds += seconds
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        adds the wall time spent in the block to the phase. phases can overlap in concurrent runs
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    def total_retries(self) -> int:
+        return sum(self.retries.values())
+
+    def report(self) -> dict:
+        with self.lock:
+            endpoints = {}
+            for endpoint, histogram in self.latency.items():
+                statuses = {status: count for (e, status), count in self.requests.items() if e == endpoint}
+                errors = sum(count for status, count in statuses.items() if not status.startswith('2'))
+                endpoints[endpoint] = {
+                    'requests': histogram.count,
+                    'status_codes': statuses,
+                    'error_rate': errors / histogram.count if histogram.count else 0,
+                    'retries': self.retries.get(endpoint, 0),
+                    'latency_seconds': {
+                        'sum': histogram.sum,
+                        'p50': histogram.quantile(0.5),
+                        'p95': histogram.quantile(0.95),
+                        'p99': histogram.quantile(0.99),
+                    },
+                    'bytes_sent': self.bytes_sent.get(endpoint, 0),
+                    'bytes_received': self.bytes_received.get(endpoint, 0),
+                }
+            return {
+                'started_at': self.started_at,
+                'duration_seconds': time.time() - self.started_at,
+                'endpoints': endpoints,
+                'phases_seconds': dict(self.phases),
+                'throttled_seconds': self.throttled_seconds,
+                'network_seconds': self.network_seconds,
+            }
+
+    def get_prometheus_lines(self, labels: dict = None) -> list[str]:
+        extra = ''.join(',' + key + '="' + str(value) + '"' for key, value in (labels or {}).items())
+        def metric(name, value, **metric_labels):
+            label_str = ','.join(key + '="' + str(label) + '"' for key, label in metric_labels.items()) + extra
+            return PROMETHEUS_PREFIX + name + ('{' + label_str.strip(',') + '}' if label_str else '') + ' ' + str(value)
+
+        with self.lock:
+            lines = ['# TYPE ' + PROMETHEUS_PREFIX + 'requests_total counter']
+            lines += [metric('requests_total', count, endpoint=endpoint, status=status) for (endpoint, status), count in sorted(self.requests.items())]
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'request_duration_seconds histogram')
+            for endpoint, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(metric('request_duration_seconds_bucket', cumulative, endpoint=endpoint, le=bound))
+                lines.append(metric('request_duration_seconds_sum', histogram.sum, endpoint=endpoint))
+                lines.append(metric('request_duration_seconds_count', histogram.count, endpoint=endpoint))
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'retries_total counter')
+            lines += [metric('retries_total', count, endpoint=endpoint) for endpoint, count in sorted(self.retries.items())]
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'bytes_sent_total counter')
+            lines += [metric('bytes_sent_total', count, endpoint=endpoint) for endpoint, count in sorted(self.bytes_sent.items())]
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'bytes_received_total counter')
+            lines += [metric('bytes_received_total', count, endpoint=endpoint) for endpoint, count in sorted(self.bytes_received.items())]
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'phase_seconds gauge')
+            lines += [metric('phase_seconds', seconds, phase=phase) for phase, seconds in sorted(self.phases.items())]
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'throttled_seconds gauge')
+            lines.append(metric('throttled_seconds', self.throttled_seconds))
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'last_run_timestamp_seconds gauge')
+            lines.append(metric('last_run_timestamp_seconds', self.started_at))
+        return lines
+
+    def write(self, directory, name='notion_habits', labels: dict = None):
+        '''
+        writes <name>.json and <name>.prom to directory. the textfile is swapped in atomically so a collector never reads half of it
+        '''
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name + '.json'), 'w') as fp:
+            json.dump(self.report(), fp, indent=1)
+        path = os.path.join(directory, name + '.prom')
+        with open(path + '.tmp', 'w') as fp:
+            fp.write('\n'.join(self.get_prometheus_lines(labels)) + '\n')
+        os.replace(path + '.tmp', path)
@@ -1,3 +1,4 @@
+import sys
 from enum import Enum
 
 class Frequency(Enum):
@@ -6,4 +7,105 @@ class Frequency(Enum):
     Monthly = '2'
     Cyclic = '3'
     
-DEFAULT_CYCLE_ICON = '🌘'
\ No newline at end of file
+DEFAULT_CYCLE_ICON = '🌘'
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+ALL_WEEK = 0b1111111
+
+def weekday_mask(isoweekdays) -> int:
+    mask = 0
+    for day in isoweekdays:
+        mask |= 1 << (day - 1)
+    return mask
+
+# weekdays each habit frequency lands on, keyed by the first character of the frequency name
+FREQUENCY_MASKS = {
+    'D': ALL_WEEK, # daily
+    'W': weekday_mask([1, 2, 3, 4, 5]), # workday, holidays are handled separately
+    '1': weekday_mask([3]), # W
+    '2': weekday_mask([2, 4]), # T R
+    '3': weekday_mask([1, 3, 5]), # M W F
+    '4': weekday_mask([1, 2, 4, 6]), # M T R S
+    '5': weekday_mask([1, 2, 3, 5, 6]), # M T W F S
+    '6': weekday_mask([1, 2, 3, 4, 5, 6]), # M T W R F S
+}
+
+def parse_days(days: str) -> int:
+    '''
+    weekday mask of a comma separated list of day names like "Monday, Wednesday"
+    '''
+    parsed_days = [day.lower() for day in days.replace(' ', '').split(',')]
+    return weekday_mask([WEEKDAYS.index(day) + 1 for day in parsed_days if day in WEEKDAYS])
+
+def intern(value):
+    '''
+    the shared copy of a string. anything else, like the {'url': ...} of an external or file icon, is kept as is
+    '''
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Habit:
+    '''
+    one habit of the catalog. the weekdays it lands on are worked out from its frequency and days once, when it's
+    loaded, and its strings are interned so every catalog in the process shares one copy of repeated names, ids,
+    icons and frequencies. it still reads like the config.json dict it's stored as (habit['name'])
+    '''
+    __slots__ = ('name', 'frequency', 'id', 'icon', 'icon_type', 'status', 'days', 'weekdays', 'skips_holidays')
+    KEYS = ('name', 'frequency', 'id', 'icon', 'icon_type', 'status', 'days')
+
+    def __init__(self, name, frequency=None, id=None, icon=None, icon_type=None, status='On', days=None):
+        self.name = intern(name)
+        self.frequency = intern(frequency)
+        self.id = intern(id)
+        self.icon = intern(icon)
+        self.icon_type = intern(icon_type)
+        self.status = intern(status)
+        self.days = intern(days)
+        # users can manually set the days they want, otherwise we just use the frequency's
+        if days:
+            self.weekdays, self.skips_holidays = parse_days(days), False
+        elif frequency:
+            self.weekdays, self.skips_holidays = FREQUENCY_MASKS.get(frequency[0], 0), frequency[0] == 'W'
+        else:
+            self.weekdays, self.skips_holidays = 0, False
+
+    @classmethod
+    def from_dict(cls, habit: dict):
+        return cls(*[habit.get(key) for key in cls.KEYS])
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.KEYS}
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            other = Habit.from_dict(other)
+        if not isinstance(other, Habit):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Habit(' + repr(self.to_dict()) + ')'
+
+def as_habit(habit) -> Habit:
+    return habit if isinstance(habit, Habit) else Habit.from_dict(habit)
+
+def get_json_default(obj):
+    '''
+    json.dump default that writes habits out as the plain dicts they were loaded from
+    '''
+    if isinstance(obj, Habit):
+        return obj.to_dict()
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
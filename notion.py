@@ -1,54 +1,599 @@
-from copy import deepcopy
+import json
+import planner
+import retention
+from bisect import bisect_right
 from datetime import datetime, timedelta
 from typing import Generator
-from holidays import US
 import utils, config
+from metrics import Metrics
+from cycles import CycleCalendar, CycleIndex, get_start, get_end, get_status
+from ledger import Ledger
+from analytics import History
+from schedule import Schedule
+from workdays import HolidayCalendar
+from templates import PageTemplate, DATE_SLOT, CYCLE_SLOT, DEFAULT_PROPERTIES
 from model import Frequency, DEFAULT_CYCLE_ICON
 YMD = '%Y-%m-%d'
 
 class Notion:
     current_habit_datetime: datetime = datetime.now()
-    def __init__(self):
+    def __init__(self, config_path = None, snapshot = False):
+        '''
+        config_path picks a config other than the config.json next to this file. with snapshot the config is read
+        through its parsed snapshot (see config.load_config)
+        '''
         try:
-            self.config = config.ConfigObject()
-            self.generator = config.ConfigGenerator()
+            self.config = config.ConfigObject(config_path or config.CONFIG_PATH, snapshot)
         except:
             raise Exception('there was an error loading your config. Are you sure you created one?')
-        self.bridge = utils.Bridge(self.config.api_key)
+        # the pool has to be at least as large as the number of requests we allow in flight
+        pool_size = max(self.config.pool_size, self.config.concurrency)
+        limiter = utils.RateLimiter.shared(self.config.api_key, self.config.requests_per_second, self.config.burst)
+        self.metrics = Metrics()
+        self.bridge = utils.Bridge(self.config.api_key, pool_size, self.config.connect_timeout, self.config.read_timeout, limiter, metrics=self.metrics)
+        # habit syncing works on the config we just loaded and shares the run's pooled session
+        self.generator = config.ConfigGenerator(config_path or config.CONFIG_PATH, self.config.config, self.bridge, snapshot)
         self.current_cycle = None
+        self.cycle_index: CycleIndex = None
+        self.cycle_calendar: CycleCalendar = None
+        self.schedule: Schedule = None
+        self.holidays: HolidayCalendar = None
+        self.ledger: Ledger = None
+        self.templates: dict[str, PageTemplate] = {}
+        # set while planning, nothing is sent or recorded as created
+        self.dry_run = False
+        # the day a run is for when it isn't today, ex: a fire the daemon missed
+        self.run_date: datetime = None
+        # replays of a recorded run (see use_cassette) leave the config file alone
+        self.save_config = True
+        # cycle status changes sent in the background, see transition_cycles
+        self.cycle_updates = None
+        self.pending_cycle_updates = []
 
-    def run(self):
+    def run(self, keep_open=False):
+        '''
+        one run of the job. keep_open leaves the pooled connections and the ledger open for the next run (see daemon.py)
+        '''
         if not self.config:
             raise Exception('config not initialized before running')
-        self.generator.load_habits()
+        # cycles may have changed in notion since an earlier run of this instance
+        self.cycle_index = None
+        self.current_cycle = None
+        try:
+            with self.metrics.phase('habit_load'):
+                self.sync_habits()
+            self.create_habits()
+            if self.config.analytics:
+                try:
+                    self.update_analytics()
+                except Exception as e:
+                    # the run's pages are created by now, stale analytics shouldn't fail it
+                    print('could not update analytics: ' + str(e))
+        finally:
+            self.close(keep_open)
+
+    def update_analytics(self) -> dict:
+        '''
+        brings the tracker history checkpoint up to date with the pages edited since the last one and summarizes it
+        (see analytics.History), writing the results back to habit and cycle pages if config.analytics_write_back is set
+        '''
+        import asyncio
+        history = History.load(self.config.analytics_path)
+        with self.metrics.phase('analytics'):
+            history.sync(self.bridge, self.config.habit_tracker_db_id)
+            summary = history.summary(self.today().strftime(YMD))
+            if self.config.analytics_write_back:
+                asyncio.run(self.write_analytics_async(summary, history))
+        history.save(self.config.analytics_path)
+        return summary
+
+    async def write_analytics_async(self, summary, history: History):
+        '''
+        updates every habit and cycle page whose numbers changed since they were last written
+        '''
+        import asyncio
+        updates = {}
+        habit_ids = {habit['id'] for habit in self.config.habits}
+        for habit_id, stats in summary['habits'].items():
+            if habit_id in habit_ids:
+                updates[habit_id] = {
+                    'Current Streak': {'number': stats['current_streak']},
+                    'Longest Streak': {'number': stats['longest_streak']},
+                    'Completion Rate': {'number': round(stats['completion_rate'], 4) if stats['completion_rate'] is not None else None},
+                }
+        for cycle_id, stats in summary['cycles'].items():
+            updates[cycle_id] = {'Completion Rate': {'number': round(stats['completion_rate'], 4) if stats['completion_rate'] is not None else None}}
+        changed = [(id, properties) for id, properties in updates.items() if history.written.get(id) != properties]
+        async with utils.AsyncBridge(self.bridge, max(self.config.concurrency, 1)) as async_bridge:
+            responses = await asyncio.gather(*[async_bridge.update_db_page(properties, id) for id, properties in changed])
+        for (id, properties), response in zip(changed, responses):
+            if response.status_code == 200:
+                history.written[id] = properties
+
+    def today(self) -> datetime:
+        '''
+        the current time in the config's timezone (the host's if it doesn't set one), or the start of run_date when set
+        '''
+        if self.run_date:
+            return self.run_date
+        if self.config.timezone:
+            from zoneinfo import ZoneInfo
+            return datetime.now(ZoneInfo(self.config.timezone)).replace(tzinfo=None)
+        return datetime.now()
+
+    def sync_habits(self):
+        '''
+        refreshes the cached habits from notion and saves them, along with the sync cursor, back to the config file
+        '''
+        self.generator.sync_habits(self.config.habits_ttl, self.config.habits_full_sync_days)
+        self.config.habits = self.generator.config.get('habits', [])
+        if not self.save_config:
+            return
+        try:
+            self.generator.save_habits()
+        except (OSError, ValueError) as e:
+            print('could not save synced habits to ' + self.generator.path + ': ' + str(e))
+
+    def create_habits(self):
         if self.config.job_frequency == Frequency.Daily.value:
-            self.create_daily_habits()
+            self.create_habits_for_dates([self.today().strftime(YMD)])
         elif self.config.job_frequency == Frequency.Weekly.value:
             self.create_weekly_habits()
         elif self.config.job_frequency == Frequency.Monthly.value:
             self.create_monthly_habits()
         elif self.config.job_frequency == Frequency.Cyclic.value:
             self.create_cyclic_habits()
+
+    def plan(self, path):
+        '''
+        works out every cycle transition and habit page a run would create and streams them to path as jsonl,
+        without making a single write call. execute_plan sends them later
+        '''
+        if not self.config:
+            raise Exception('config not initialized before running')
+        bridge = self.bridge
+        try:
+            with open(path, 'w') as fp:
+                self.bridge = planner.PlanningBridge(bridge, fp)
+                self.dry_run = True
+                with self.metrics.phase('habit_load'):
+                    self.sync_habits()
+                self.create_habits()
+        finally:
+            self.bridge = bridge
+            self.dry_run = False
+            # whatever we learned about cycles while planning points at placeholder ids
+            self.cycle_index = None
+            self.current_cycle = None
+            self.close()
+
+    def execute_plan(self, path):
+        '''
+        replays a plan written by plan() through the bridge at the full allowed rate
+        '''
+        import asyncio
+        try:
+            asyncio.run(self.execute_plan_async(path))
+        finally:
+            self.close()
+
+    async def execute_plan_async(self, path):
+        '''
+        cycle creations and updates are sent in plan order, each finishing before the next record is read, so every
+        placeholder id is resolved before a habit page refers to it. habit pages are queued as they're read and share
+        config.concurrency requests in flight, so they keep flowing while cycle writes are waited on.
+        a cycle an earlier execution of the plan already created (an open cycle with the same date range) is reused
+        rather than created again
+        '''
+        import asyncio
+        refs = {}
+        async with utils.AsyncBridge(self.bridge, max(self.config.concurrency, 1)) as async_bridge:
+            pending = []
+            for record in planner.read_plan(path):
+                properties = planner.resolve_refs(record['properties'], refs)
+                if record['op'] == 'update':
+                    await async_bridge.update_db_page(properties, planner.resolve_refs(record['id'], refs))
+                elif record['db_id'] == self.config.habit_tracker_db_id:
+                    pending.append(asyncio.create_task(async_bridge.call(self.create_planned_page, properties, record['icon'], record['icon_type'])))
+                else:
+                    if record['db_id'] == self.config.cycles_db_id:
+                        date_range = properties['Date Range']['date']
+                        cycle = self.get_cycle_index().find(date_range['start'], date_range['end'])
+                        if cycle:
+                            refs[record['ref']] = cycle['id']
+                            continue
+                    result = await async_bridge.create_db_page(record['db_id'], properties, record['icon'], record['icon_type'])
+                    if 'id' not in result:
+                        raise Exception('failed to create ' + record['ref'] + ' from plan')
+                    refs[record['ref']] = result['id']
+            await asyncio.gather(*pending)
+
+    def create_planned_page(self, properties, icon, icon_type):
+        '''
+        creates a habit page from a plan, unless the ledger shows an earlier execution already did
+        '''
+        date = properties['Date']['date']['start']
+        habit = {'id': properties['Habit (Relation)']['relation'][0]['id']}
+        ledger = self.get_ledger()
+        if ledger and habit['id'] in ledger.created(self.config.habit_tracker_db_id, [date])[date]:
+            return None
+        return self.create_habit_page(habit, date, utils.get_page_payload(self.config.habit_tracker_db_id, properties, icon, icon_type))
+
+    def use_cassette(self, path, mode, latency=0):
+        '''
+        mode "record" writes every response of the run to a cassette at path, "replay" answers every request from one
+        instead of notion (see cassette.py). a replay runs for the day the cassette was recorded for, and keeps its
+        ledger in memory and skips analytics and saving the config so it leaves no trace behind
+        '''
+        if mode == 'record':
+            self.bridge.record(path, {'run_date': self.today().strftime(YMD)})
+        elif mode == 'replay':
+            header = self.bridge.replay(path, latency)
+            self.run_date = self.run_date or datetime.fromisoformat(header['run_date'])
+            self.config.ledger_path = ':memory:'
+            self.config.analytics = False
+            self.save_config = False
+        else:
+            raise Exception('unknown cassette mode ' + mode + ', expected record or replay')
+
+    def close(self, keep_open=False):
+        '''
+        releases pooled connections and reports how the run went, writing the run's metrics if config.metrics_dir is set.
+        with keep_open only the report is done
+        '''
+        self.finish_cycle_transitions()
+        stats = self.bridge.stats()
+        if self.config.metrics_dir:
+            try:
+                if self.config.tenant:
+                    self.metrics.write(self.config.metrics_dir, 'notion_habits-' + self.config.tenant, {'tenant': self.config.tenant})
+                else:
+                    self.metrics.write(self.config.metrics_dir)
+            except OSError as e:
+                print('could not write metrics to ' + self.config.metrics_dir + ': ' + str(e))
+        if self.ledger:
+            self.ledger.compact(self.config.ledger_retention_days)
+        if not keep_open:
+            if self.cycle_updates:
+                self.cycle_updates.shutdown()
+                self.cycle_updates = None
+            self.bridge.close()
+            if self.ledger:
+                self.ledger.close()
+                self.ledger = None
+        print('sent ' + str(stats['requests']) + ' requests over ' + str(stats['connections_opened']) + ' connections (' + str(stats['connections_reused']) + ' reused)')
+        print(str(stats['retries']) + ' retries, ' + str(stats['throttled_seconds']) + 's throttled, ' + str(stats['network_seconds']) + 's on the network')
         
+    def backfill(self, start: str, end: str):
+        '''
+        creates every cycle and habit page from start to end (YMD, both inclusive), past or future, in one pass.
+        habit pages already in the tracker for those dates are left alone
+        '''
+        import asyncio
+        if not self.config:
+            raise Exception('config not initialized before running')
+        if datetime.fromisoformat(start) > datetime.fromisoformat(end):
+            raise Exception('backfill start ' + start + ' is after its end ' + end)
+        try:
+            with self.metrics.phase('habit_load'):
+                self.sync_habits()
+            with self.metrics.phase('planning'):
+                periods = self.get_cycle_periods(start, end)
+                plan = self.plan_habits(self.get_date_range(start, end), self.get_existing_pages(start, end))
+            asyncio.run(self.backfill_async(periods, plan))
+        finally:
+            self.cycle_index = None
+            self.current_cycle = None
+            self.close()
+
+    async def backfill_async(self, periods, plan):
+        '''
+        creates the missing cycles concurrently, then every planned page concurrently with its cycle already known
+        '''
+        cycles = await self.create_cycles_async(periods)
+        starts = [period_start for period_start, _, _ in periods]
+        cycle_ids = {date: cycles[starts[bisect_right(starts, date) - 1]] for date, _ in plan}
+        await self.create_habits_async(plan, cycle_ids)
+
+    def get_cycle_periods(self, start: str, end: str) -> list[tuple[str, str, int]]:
+        '''
+        (start, end, index of the next cycle date) of every cycle overlapping start to end, cycle ends being exclusive
+        '''
+        periods = self.get_cycle_calendar().periods(datetime.fromisoformat(start), datetime.fromisoformat(end))
+        return [(period_start.strftime(YMD), period_end.strftime(YMD), next_cycle_idx) for period_start, period_end, next_cycle_idx in periods]
+
+    def get_existing_pages(self, start: str, end: str) -> dict[str, set[str]]:
+        '''
+        ids of the habits with a tracker page on each date from start to end, whoever created them.
+        pages the ledger doesn't know about yet are recorded in it
+        '''
+        existing = {}
+        ledger = self.get_ledger()
+        for date, habit_id, page in self.stream_tracker_pages(start, end):
+            existing.setdefault(date, set()).add(habit_id)
+            if ledger:
+                ledger.mark_done(self.config.habit_tracker_db_id, date, habit_id, page['id'])
+        return existing
+
+    def stream_tracker_pages(self, start: str, end: str) -> Generator[tuple[str, str, dict], None, None]:
+        '''
+        (date, habit id, page) of every habit tracker page from start to end, fetched a page of results at a time
+        with only the date and habit properties. pages missing either are skipped
+        '''
+        for page in self.bridge.stream(self.config.habit_tracker_db_id, {
+            'filter': {
+                'and': [
+                    {'property': 'Date', 'date': {'on_or_after': start}},
+                    {'property': 'Date', 'date': {'on_or_before': end}},
+                ]
+            }
+        }, filter_properties=['Date', 'Habit (Relation)'], prefetch=True):
+            date = page['properties']['Date']['date']
+            relation = page['properties']['Habit (Relation)']['relation']
+            if date and relation:
+                yield date['start'][:10], relation[0]['id'], page
+
+    def audit(self, start: str, end: str, fix=False) -> dict:
+        '''
+        compares the habit tracker from start to end (YMD, both inclusive) with the pages the schedule calls for.
+        reports scheduled habits with more than one page on a date, scheduled habits with none, and pages for habits that
+        weren't scheduled that day. with fix, the oldest of each set of duplicates is kept and the rest archived, and
+        missing pages are created as a backfill would. pages for unscheduled habits are only reported
+        '''
+        import asyncio
+        if not self.config:
+            raise Exception('config not initialized before running')
+        try:
+            with self.metrics.phase('habit_load'):
+                self.sync_habits()
+            with self.metrics.phase('planning'):
+                # (created time, page id) of the pages found for each (habit id, date), and the habit ids found on each date
+                found: dict[tuple[str, str], list[tuple[str, str]]] = {}
+                found_on: dict[str, list[str]] = {}
+                for date, habit_id, page in self.stream_tracker_pages(start, end):
+                    if (habit_id, date) not in found:
+                        found[(habit_id, date)] = []
+                        found_on.setdefault(date, []).append(habit_id)
+                    found[(habit_id, date)].append((page.get('created_time', ''), page['id']))
+                schedule = self.get_schedule()
+                names = {habit['id']: habit['name'] for habit in self.config.habits}
+                report = {'duplicates': [], 'missing': [], 'unexpected': []}
+                missing_plan = []
+                for date, habits in self.get_habit_matrix(list(self.get_date_range(start, end))):
+                    expected = {habit['id'] for habit in schedule.habits_for(habits)}
+                    missing = [habit_id for habit_id in expected if (habit_id, date) not in found]
+                    if missing:
+                        missing_plan.append((date, schedule.mask_of(missing)))
+                        report['missing'] += [{'habit': names[habit_id], 'habit_id': habit_id, 'date': date} for habit_id in sorted(missing)]
+                    for habit_id in found_on.get(date, []):
+                        pages = sorted(found[(habit_id, date)])
+                        if habit_id not in expected:
+                            report['unexpected'].append({'habit': names.get(habit_id), 'habit_id': habit_id, 'date': date, 'pages': [id for _, id in pages]})
+                        elif len(pages) > 1:
+                            report['duplicates'].append({'habit': names[habit_id], 'habit_id': habit_id, 'date': date, 'kept': pages[0][1], 'extra': [id for _, id in pages[1:]]})
+            if fix and (report['duplicates'] or missing_plan):
+                asyncio.run(self.repair_async(report['duplicates'], self.get_cycle_periods(start, end) if missing_plan else [], missing_plan))
+            return report
+        finally:
+            self.cycle_index = None
+            self.current_cycle = None
+            self.close()
+
+    async def repair_async(self, duplicates, periods, missing_plan):
+        import asyncio
+        async with utils.AsyncBridge(self.bridge, max(self.config.concurrency, 1)) as async_bridge:
+            with self.metrics.phase('archive'):
+                await asyncio.gather(*[async_bridge.archive_page(id) for duplicate in duplicates for id in duplicate['extra']])
+        if missing_plan:
+            await self.backfill_async(periods, missing_plan)
+
+    def retain(self, days=None, archived_cycles=False, export_path=None) -> dict:
+        '''
+        archives the tracker pages dated more than days (config.tracker_retention_days by default) ago, and with
+        archived_cycles every page of an archived cycle, so the tracker only holds what the job and its views still use.
+        with export_path every page is appended to that jsonl file before it's archived. progress is checkpointed to
+        config.retention_path, a rerun after an interruption carries on from there. returns how many pages were found,
+        exported, archived and failed to archive
+        '''
+        import asyncio
+        if not self.config:
+            raise Exception('config not initialized before running')
+        days = self.config.tracker_retention_days if days is None else days
+        cutoff = (self.today() - timedelta(days=days)).strftime(YMD) if days is not None else None
+        checkpoint = retention.Checkpoint(self.config.retention_path)
+        report = {'found': 0, 'exported': 0, 'archived': 0, 'failed': 0}
+        # an interrupted scan or archive keeps its checkpoint for the rerun, even though nothing has failed yet
+        completed = False
+        try:
+            cycle_ids = []
+            if archived_cycles:
+                cycle_ids = [cycle['id'] for cycle in self.bridge.stream(self.config.cycles_db_id, {'filter': {'property': 'Status', 'select': {'equals': 'Archive'}}}, filter_properties=['Status'])]
+            with self.metrics.phase('retention_scan'):
+                # pages are only archived once the scan is done, archiving while following a cursor could skip pages
+                page_ids = self.export_retired_pages(retention.get_retention_queries(cutoff, cycle_ids), export_path, checkpoint, report)
+            with self.metrics.phase('archive'):
+                asyncio.run(self.archive_retired_pages_async(page_ids, checkpoint, report))
+            completed = True
+            return report
+        finally:
+            checkpoint.close(finished=completed and not report['failed'])
+            self.close()
+
+    def export_retired_pages(self, queries, export_path, checkpoint: retention.Checkpoint, report) -> list[str]:
+        '''
+        ids of every tracker page matching one of queries that isn't archived yet, exporting the ones not exported yet
+        '''
+        page_ids = {}
+        fp = open(export_path, 'a') if export_path else None
+        try:
+            for body in queries:
+                # an export keeps the whole page, otherwise the date is all we need to see
+                for page in self.bridge.stream(self.config.habit_tracker_db_id, body, filter_properties=None if fp else ['Date'], prefetch=True):
+                    if page['id'] in page_ids or (retention.ARCHIVED, page['id']) in checkpoint:
+                        continue
+                    page_ids[page['id']] = True
+                    if fp and (retention.EXPORTED, page['id']) not in checkpoint:
+                        fp.write(json.dumps(page) + '\n')
+                        fp.flush()
+                        checkpoint.mark(retention.EXPORTED, page['id'])
+                        report['exported'] += 1
+        finally:
+            if fp:
+                fp.close()
+        report['found'] = len(page_ids)
+        return list(page_ids)
+
+    async def archive_retired_pages_async(self, page_ids, checkpoint: retention.Checkpoint, report):
+        import asyncio
+        def archive(id):
+            if self.bridge.archive_page(id).status_code == 200:
+                checkpoint.mark(retention.ARCHIVED, id)
+        async with utils.AsyncBridge(self.bridge, max(self.config.concurrency, 1)) as async_bridge:
+            await asyncio.gather(*[async_bridge.call(archive, id) for id in page_ids])
+        report['archived'] = sum((retention.ARCHIVED, id) in checkpoint for id in page_ids)
+        report['failed'] = len(page_ids) - report['archived']
+
+    async def create_cycles_async(self, periods) -> dict[str, str]:
+        '''
+        ids of the cycles for each period start, creating the missing ones concurrently. new cycles are archived, active or
+        upcoming depending on where their dates fall relative to today. as in create_cycle, an upcoming cycle starting
+        with a period but ending elsewhere is marked as an error
+        '''
+        import asyncio
+        today = self.today().strftime(YMD)
+        existing = {}
+        conflicts = []
+        active = None
+        for cycle in self.bridge.stream(self.config.cycles_db_id, {
+            'filter': {
+                'and': [
+                    {'property': 'Date Range', 'date': {'on_or_after': periods[0][0]}},
+                    {'property': 'Status', 'select': {'does_not_equal': 'Error'}},
+                ]
+            }
+        }):
+            if get_status(cycle) == 'Active':
+                active = cycle
+            if any(get_start(cycle) == start and get_end(cycle) == end for start, end, _ in periods):
+                existing[get_start(cycle)] = cycle['id']
+            elif get_status(cycle) == 'Upcoming' and any(get_start(cycle) == start for start, _, _ in periods):
+                conflicts.append(cycle['id'])
+
+        async with utils.AsyncBridge(self.bridge, max(self.config.concurrency, 1)) as async_bridge:
+            missing = [(start, end, next_cycle_idx) for start, end, next_cycle_idx in periods if start not in existing]
+            creates_active = any(start <= today < end for start, end, _ in missing)
+            updates = [async_bridge.update_db_page({'Status': {'select': {'name': 'Error'}}}, id) for id in conflicts]
+            # only one cycle is active at a time
+            if creates_active and active:
+                updates.append(async_bridge.update_db_page({'Status': {'select': {'name': 'Archive'}}}, active['id']))
+            await asyncio.gather(*updates)
+            results = await asyncio.gather(*[async_bridge.create_db_page(
+                self.config.cycles_db_id,
+                self.get_cycle_properties(datetime.fromisoformat(start), end, next_cycle_idx, 'Archive' if end <= today else 'Active' if start <= today else 'Upcoming'),
+                DEFAULT_CYCLE_ICON,
+                'emoji',
+            ) for start, end, next_cycle_idx in missing])
+        for (start, _, _), result in zip(missing, results):
+            if 'id' not in result:
+                raise Exception('failed to create the cycle starting ' + start)
+            existing[start] = result['id']
+        return existing
+
     def create_cyclic_habits(self):
-        for date in self.get_week():
-            self.get_dates_til_next_cycle(date)
+        '''creates habits from today up to the start of the next cycle'''
+        self.create_habits_for_dates(self.get_dates_til_next_cycle())
         
     def create_weekly_habits(self):
         '''creates habits for 1 week, not necessarily Sunday - Sunday'''
-        for date in self.get_week():
-            self.create_daily_habits(date)
+        self.create_habits_for_dates(self.get_week())
     
     def create_monthly_habits(self):
-        for date in self.get_month():
-            self.create_daily_habits(date)
+        self.create_habits_for_dates(self.get_month())
+
+    def create_habits_for_dates(self, dates):
+        '''
+        creates daily habits for every date provided, concurrently if the config allows more than one request in flight
+        '''
+        with self.metrics.phase('planning'):
+            plan = self.plan_habits(dates)
+        if not plan:
+            return
+        if self.config.concurrency > 1 and not self.dry_run:
+            import asyncio
+            asyncio.run(self.create_habits_async(plan))
+            return
+        for date, habits in plan:
+            self.create_daily_habits(date, self.schedule.habits_for(habits))
+
+    def plan_habits(self, dates, existing: dict[str, set[str]] = None) -> list[tuple[str, int]]:
+        '''
+        pairs every date with the bitmask of habits due on it (see Schedule), computed for the whole range in one pass.
+        habits with a page already, per the ledger or existing (ids by date), are left out
+        '''
+        dates = list(dates)
+        schedule = self.get_schedule()
+        plan = self.get_habit_matrix(dates)
+        ledger = self.get_ledger()
+        if not ledger and not existing:
+            return plan
+        created = ledger.created(self.config.habit_tracker_db_id, dates) if ledger else {}
+        today = self.today()
+        resumed_plan = []
+        for date, habits in plan:
+            remaining = habits & ~schedule.mask_of(created.get(date, set()) | (existing or {}).get(date, set()))
+            # every page for the date was created by an earlier run, so there's nothing to send and its cycle is known.
+            # except on the day a cycle starts: the pages may have been created ahead of time (see backfill), but
+            # archiving the old cycle and activating the new one only happens on the day itself
+            if habits and not remaining:
+                if date == today.strftime(YMD) and today.day in self.config.new_cycle_dates:
+                    resumed_plan.append((date, 0))
+                continue
+            resumed_plan.append((date, remaining))
+        return resumed_plan
+
+    def get_habit_matrix(self, dates: list[str]) -> list[tuple[str, int]]:
+        '''
+        every date paired with the bitmask of the habits get_filtered_habits would give for it
+        '''
+        schedule = self.get_schedule()
+        datetimes = [datetime.fromisoformat(date) for date in dates]
+        holidays = ()
+        # only workday habits care about holidays, so runs without any never load a calendar
+        if schedule.workday_habits:
+            holidays = self.get_holidays()
+            holidays.prepare(datetimes)
+        return list(zip(dates, schedule.matrix(datetimes, holidays)))
+
+    async def create_habits_async(self, plan, cycle_ids: dict[str, str] = None):
+        '''
+        async run path: cycles are still resolved one date at a time, in order, and a date's habit pages are only
+        queued once its cycle id is known. pages from every date then share a bounded number of in-flight requests.
+        cycle_ids can map every date of the plan to a cycle resolved up front (see backfill)
+        '''
+        import asyncio
+        async with utils.AsyncBridge(self.bridge, max(self.config.concurrency, 1)) as async_bridge:
+            # page creation starts with the first queued page, so it overlaps with cycle resolution here
+            with self.metrics.phase('page_creation'):
+                pending = []
+                for date, habits in plan:
+                    self.current_habit_datetime = datetime.fromisoformat(date)
+                    if cycle_ids:
+                        current_cycle_id = cycle_ids[date]
+                    else:
+                        with self.metrics.phase('cycle_resolution'):
+                            current_cycle_id = await asyncio.to_thread(self.get_current_cycle_id)
+                    if not current_cycle_id:
+                        raise Exception('failed to get current_cycle_id')
+                    for habit, body in self.get_habit_pages(self.schedule.habits_for(habits), current_cycle_id):
+                        pending.append(asyncio.create_task(async_bridge.call(self.create_habit_page, habit, date, body)))
+                await asyncio.gather(*pending)
 
         
     def get_week(self) -> Generator[str, None, None]:
         '''
         a generator of week dates in format YMD used when creating weekly habits
         '''
-        today = datetime.now()
+        today = self.today()
         for i in range(7):
             yield (today + timedelta(days=i)).strftime(YMD)
 
@@ -56,7 +601,7 @@ class Notion:
         '''
         generates a list of days from today -> end of month inclusive
         '''
-        today = date = datetime.now()
+        today = date = self.today()
         curr_month = today.month
         i = 1
         while curr_month == date.month:
@@ -64,59 +609,109 @@ class Notion:
             date = today + timedelta(days=i)
             i += 1
     
-    def get_dates_til_next_cycle(self):
-        date = datetime.now()
-        end_date, _ = self.get_cycle_end_date()
-        end_date = end_date.strftime(YMD)
-        formatted_date = date.strftime(YMD)
-        while formatted_date != end_date:
-            yield formatted_date
-            date = date + timedelta(days=1)
-            formatted_date = date.strftime(YMD)
+    def get_date_range(self, start: str, end: str) -> Generator[str, None, None]:
+        date = datetime.fromisoformat(start)
+        while date.strftime(YMD) <= end:
+            yield date.strftime(YMD)
+            date += timedelta(days=1)
+
+    def get_dates_til_next_cycle(self) -> Generator[str, None, None]:
+        '''
+        today through the last day of the cycle containing it
+        '''
+        today = self.today()
+        _, end_date, _ = self.get_cycle_calendar().containing(today)
+        return self.get_date_range(today.strftime(YMD), (end_date - timedelta(days=1)).strftime(YMD))
     
-    def create_daily_habits(self, date = None):
+    def create_daily_habits(self, date = None, habits = None):
         '''
-        creates daily habits for a provided date, otherwise today if none is provided
+        creates daily habits for a provided date, otherwise today if none is provided.
+        habits can be passed in when they've already been filtered for the date
         '''
         if date:
             self.current_habit_datetime = datetime.fromisoformat(date)
-        current_cycle_id = self.get_current_cycle_id()
+        with self.metrics.phase('cycle_resolution'):
+            current_cycle_id = self.get_current_cycle_id()
         if not current_cycle_id:
             raise Exception('failed to get current_cycle_id')
-        filtered_habits = self.get_filtered_habits()
-        for habit in filtered_habits:
-            properties = {
-                'Name': {
-                    'title': [{'type': 'text', 'text': {'content': habit['name']}}],
-                },
-                'Date': {
-                    'date': {'start': self.current_habit_datetime.strftime(YMD)},
-                },
-                'Cycle': {
-                    'relation': [{'id': current_cycle_id}],
-                },
-                'Progress': {
-                    'checkbox': False,
-                },
-                'Neutral': {
-                    'checkbox': False,
-                },
-                'Missed': {
-                    'checkbox': True,
-                },
-                'Setback Notes': {
-                    'rich_text': [{'type': 'text', 'text': {'content': ''}}],
-                },
-                'Habit': {
-                    'select': {'name': habit['name']},
-                },
-                'Habit (Relation)': {
-                    'relation': [{
-                        'id': habit['id'],
-                    }],
-                },
-            }
-            self.bridge.create_db_page(self.config.habit_tracker_db_id, properties, habit['icon'], habit['icon_type'])
+        filtered_habits = self.get_filtered_habits() if habits is None else habits
+        date = self.current_habit_datetime.strftime(YMD)
+        with self.metrics.phase('page_creation'):
+            for habit, body in self.get_habit_pages(filtered_habits, current_cycle_id):
+                self.create_habit_page(habit, date, body)
+
+    def get_habit_pages(self, habits, current_cycle_id) -> list[tuple[dict, bytes]]:
+        '''
+        (habit, encoded create request) for each of habits on self.current_habit_datetime, journaled in the ledger before any are sent
+        '''
+        date = self.current_habit_datetime.strftime(YMD)
+        pages = [(habit, self.get_page_template(habit).render(date, current_cycle_id)) for habit in habits]
+        ledger = self.get_ledger()
+        if ledger and pages and not self.dry_run:
+            ledger.journal(self.config.habit_tracker_db_id, self.current_habit_datetime.strftime(YMD), [habit['id'] for habit, _ in pages])
+        return pages
+
+    def create_habit_page(self, habit, date, body):
+        result = self.bridge.create_page_from_body(body)
+        ledger = self.get_ledger()
+        if ledger and 'id' in result and not self.dry_run:
+            ledger.mark_done(self.config.habit_tracker_db_id, date, habit['id'], result['id'])
+        return result
+
+    def get_ledger(self) -> Ledger | None:
+        if self.ledger is None and self.config.use_ledger:
+            self.ledger = Ledger(self.config.ledger_path)
+        return self.ledger
+
+    def get_page_template(self, habit) -> PageTemplate:
+        '''
+        the habit's create request, built and encoded once per run with only the date and cycle left to fill in
+        '''
+        template = self.templates.get(habit['id'])
+        if template is None or template.habit is not habit:
+            template = PageTemplate(habit, self.config.habit_tracker_db_id, self.get_habit_properties(habit, CYCLE_SLOT, DATE_SLOT))
+            self.templates[habit['id']] = template
+        return template
+
+    def get_habit_properties(self, habit, current_cycle_id, date = None) -> dict:
+        '''
+        properties of a habit tracker page for the habit on date, otherwise self.current_habit_datetime
+        '''
+        properties = {
+            'Name': {
+                'title': [{'type': 'text', 'text': {'content': habit['name']}}],
+            },
+            'Date': {
+                'date': {'start': date or self.current_habit_datetime.strftime(YMD)},
+            },
+            'Cycle': {
+                'relation': [{'id': current_cycle_id}],
+            },
+            'Progress': {
+                'checkbox': False,
+            },
+            'Neutral': {
+                'checkbox': False,
+            },
+            'Missed': {
+                'checkbox': True,
+            },
+            'Setback Notes': {
+                'rich_text': [{'type': 'text', 'text': {'content': ''}}],
+            },
+            'Habit': {
+                'select': {'name': habit['name']},
+            },
+            'Habit (Relation)': {
+                'relation': [{
+                    'id': habit['id'],
+                }],
+            },
+        }
+        if not self.config.include_default_properties:
+            for name in DEFAULT_PROPERTIES:
+                del properties[name]
+        return properties
             
     def get_current_cycle_id(self):
         # create new cycle if we need to, either in upcoming or active state
@@ -133,66 +728,26 @@ class Notion:
         self.create_cycle()
         return self.current_cycle['id']
 
+    def get_cycle_index(self) -> CycleIndex:
+        '''
+        every open cycle, queried once per run and kept up to date as we create and update cycles
+        '''
+        if self.cycle_index is None:
+            self.cycle_index = CycleIndex.load(self.bridge, self.config.cycles_db_id)
+        return self.cycle_index
+
     def get_active_cycle(self):
         '''
         gets cycle in active state, regardless of its dates
         '''
-        if self.current_cycle and self.current_cycle['properties']['Status']['select']['name'] == 'Active': return self.active_cycle
-        response = self.bridge.query(self.config.cycles_db_id, {
-                'filter': {
-                    'property': 'Status',
-                    'select': {
-                        'equals': 'Active'
-                    }
-                }
-            })
-        r = response.json()
-        return r['results'][0] if 'results' in r and r['results'] else None
+        return self.get_cycle_index().active()
 
     def get_period_cycle(self):
         '''
         gets the cycle that contains self.current_habit_datetime
         '''
-        habit_dt_formatted = self.current_habit_datetime.strftime(YMD)
-        # notion doesn't let us filter by end date for some reason
-        response = self.bridge.query(self.config.cycles_db_id, {
-                'filter': {
-                    'and': [
-                        {
-                            'property': 'Date Range',
-                            'date': {
-                                'on_or_before': habit_dt_formatted
-                            }
-                        },
-                        {
-                            'or': [
-                                {
-                                    'property': 'Status',
-                                    'select': {
-                                        'does_not_equal': 'Archive'
-                                    }
-                                },
-                                {
-                                    'property': 'Status',
-                                    'select': {
-                                        'does_not_equal': 'Error'
-                                    }
-                                }
-                            ]
-                        }
-                    ]
-                }
-            })
-        r = response.json()
-        results = r['results'] if 'results' in r and r['results'] else None
-        if not results: return results
+        return self.get_cycle_index().containing(self.current_habit_datetime.strftime(YMD))
 
-        for r in results:
-            cycle = r['properties']
-            if cycle['Date Range']['date']['end'] > habit_dt_formatted:
-                return r
-
-        
     def create_cycle(self):
         '''
         creates a new monthly cycle or activates an upcoming cycle, setting in the class property current_cycle
@@ -200,142 +755,146 @@ class Notion:
         active_cycle = None
         end_date, next_cycle_idx = self.get_cycle_end_date()
         end_date_formatted = end_date.strftime(YMD)
-        now_formatted = datetime.now().strftime(YMD)
+        now_formatted = self.today().strftime(YMD)
         habit_datetime_formatted = self.current_habit_datetime.strftime(YMD)
         needs_new_cycle_today = now_formatted == habit_datetime_formatted
 
+        # status changes are collected and sent together, the pages only need the id of the cycle we end up with
+        transitions = {}
         if needs_new_cycle_today:
             active_cycle = self.get_active_cycle()
+            # an earlier run today already started this cycle
+            if active_cycle and get_start(active_cycle) == habit_datetime_formatted and get_end(active_cycle) == end_date_formatted:
+                self.current_cycle = active_cycle
+                return active_cycle
             if active_cycle:
-                self.update_cycle_state('Archive', active_cycle['id'])
+                transitions[active_cycle['id']] = 'Archive'
         
         cycles_resp = self.get_upcoming_cycles() or []
         # error any cycles with conflicting dates
         for cycle in cycles_resp:
             if cycle['properties']['Date Range']['date']['start'] == habit_datetime_formatted and cycle['properties']['Date Range']['date']['end'] != end_date_formatted:
-                self.update_cycle_state('Error', cycle['id'])
+                transitions[cycle['id']] = 'Error'
         
         # activate valid cycle if it exists and we need it, otherwise find existing valid upcoming cycle
         for cycle in cycles_resp:
             if needs_new_cycle_today and cycle['properties']['Date Range']['date']['start'] == now_formatted and cycle['properties']['Date Range']['date']['end'] == end_date_formatted:
-                self.update_cycle_state('Active', cycle['id'])
+                transitions[cycle['id']] = 'Active'
+                self.transition_cycles(transitions)
                 self.current_cycle = cycle
                 return cycle # returning the cycle here with no update as its id may be used in the future, current state will not
             elif not needs_new_cycle_today and cycle['properties']['Date Range']['date']['start'] == habit_datetime_formatted and cycle['properties']['Date Range']['date']['end'] == end_date_formatted:
+                self.transition_cycles(transitions)
                 self.current_cycle = cycle
                 return cycle
 
+        self.transition_cycles(transitions)
         # no cycle to activate means we create a new one
-        new_cycle_properties = {
+        new_cycle_properties = self.get_cycle_properties(self.current_habit_datetime, end_date_formatted, next_cycle_idx, 'Active' if needs_new_cycle_today else 'Upcoming')
+        result = self.bridge.create_db_page(self.config.cycles_db_id, new_cycle_properties, utils.get_icon(active_cycle or self.current_cycle) or DEFAULT_CYCLE_ICON, utils.get_icon_type(active_cycle or self.current_cycle) or 'emoji')
+        if 'id' in result and 'properties' in result:
+            self.get_cycle_index().add(result)
+        self.current_cycle = result
+    
+    def get_cycle_properties(self, start: datetime, end: str, next_cycle_idx, status) -> dict:
+        return {
             'Name': {
                 'title': [
                     {
                         'text': {
-                            'content': self.current_habit_datetime.strftime('%B') + (' (part ' + str(next_cycle_idx + 1)  + ')' if len(self.config.new_cycle_dates) > 1 else ''),
+                            'content': start.strftime('%B') + (' (part ' + str(next_cycle_idx + 1)  + ')' if len(self.config.new_cycle_dates) > 1 else ''),
                         }
                     }
                 ]
             },
             'Date Range': {
                 'date': {
-                    'start': habit_datetime_formatted,
-                    'end': end_date_formatted,
+                    'start': start.strftime(YMD),
+                    'end': end,
                 }
             },
             'Status': {
                 'select': {
-                    "name": "Active" if needs_new_cycle_today else 'Upcoming',
+                    "name": status,
                 }
             }
         }
-        result = self.bridge.create_db_page(self.config.cycles_db_id, new_cycle_properties, utils.get_icon(active_cycle or self.current_cycle) or DEFAULT_CYCLE_ICON, utils.get_icon_type(active_cycle or self.current_cycle) or 'emoji')
-        self.current_cycle = result
-    
-    def update_cycle_state(self, state, id):
-        to_update = {
-            'Status':  {
-                'select': {
-                    'name': state,
-                }
-            }
-        }
-        return self.bridge.update_db_page(to_update, id)
+
+    def transition_cycles(self, transitions: dict[str, str]):
+        '''
+        sends cycle status changes (the new state by cycle id) on background threads, skipping cycles the index already
+        has in their target state. the index is updated right away, so the run moves on to its habit pages while the
+        changes are in flight. finish_cycle_transitions waits for them
+        '''
+        index = self.get_cycle_index()
+        changed = [(id, state) for id, state in transitions.items() if index.status(id) != state]
+        for id, state in changed:
+            index.set_status(id, state)
+        for id, state in changed:
+            properties = {'Status': {'select': {'name': state}}}
+            if self.dry_run:
+                # a plan is written in the order its calls are made
+                self.bridge.update_db_page(properties, id)
+                continue
+            if not self.cycle_updates:
+                from concurrent.futures import ThreadPoolExecutor
+                self.cycle_updates = ThreadPoolExecutor(max_workers=max(self.config.concurrency, 1), thread_name_prefix='cycle')
+            self.pending_cycle_updates.append((id, state, self.cycle_updates.submit(self.bridge.update_db_page, properties, id)))
+
+    def finish_cycle_transitions(self) -> int:
+        '''
+        waits for every cycle status change still in flight, returns how many failed. a failed change is picked up
+        again by the next run, which reloads the index from notion
+        '''
+        failed = 0
+        pending, self.pending_cycle_updates = self.pending_cycle_updates, []
+        for id, state, future in pending:
+            try:
+                response = future.result()
+                ok = response.status_code == 200
+            except Exception as e:
+                print(e)
+                ok = False
+            if not ok:
+                print('failed to set cycle ' + id + ' to ' + state)
+                failed += 1
+        return failed
     
     def get_upcoming_cycles(self):
-        response = self.bridge.query(self.config.cycles_db_id, {
-                'filter': {
-                    'property': 'Status',
-                    'select': {
-                        'equals': 'Upcoming'
-                    }
-                }
-            })
-        r = response.json()
-        if not ('results' in r and r['results']):
-            return None
-        
-        r = r['results']
-        return r
+        return self.get_cycle_index().upcoming() or None
         
     def get_cycle_end_date(self) -> tuple[datetime, int]:
-        next_cycle_idx = ((self.config.new_cycle_dates.index(self.current_habit_datetime.day) + 1) % len(self.config.new_cycle_dates)) if self.current_habit_datetime.day in self.config.new_cycle_dates else None
-        end_date = deepcopy(self.current_habit_datetime)
-        min_dif = 32
-        if next_cycle_idx is None:
-            for idx, date in enumerate(self.config.new_cycle_dates):
-                if date - end_date.day < min_dif and date - end_date.day > 0:
-                    min_dif = date - end_date.day
-                    next_cycle_idx = idx
-                    
-        if next_cycle_idx or min_dif < 32:
-            end_date = end_date.replace(day=self.config.new_cycle_dates[next_cycle_idx])
-        else:
-            next_cycle_idx = 0
-            end_date = end_date.replace(day=self.config.new_cycle_dates[0], month=(1 if end_date.month == 12 else end_date.month + 1))
+        '''
+        the start of the cycle after the one containing self.current_habit_datetime, and which of new_cycle_dates it falls on
+        '''
+        _, end_date, next_cycle_idx = self.get_cycle_calendar().containing(self.current_habit_datetime)
         return end_date, next_cycle_idx
+
+    def get_cycle_calendar(self) -> CycleCalendar:
+        '''
+        the cycle boundaries of config.new_cycle_dates, worked out again only when the list is replaced
+        '''
+        if self.cycle_calendar is None or self.cycle_calendar.new_cycle_dates is not self.config.new_cycle_dates:
+            self.cycle_calendar = CycleCalendar(self.config.new_cycle_dates)
+        return self.cycle_calendar
         
+    def get_schedule(self) -> Schedule:
+        '''
+        the compiled schedule of config.habits, recompiled only when the habit list is replaced
+        '''
+        if self.schedule is None or self.schedule.habits is not self.config.habits:
+            self.schedule = Schedule(self.config.habits)
+        return self.schedule
+
+    def get_holidays(self) -> HolidayCalendar:
+        if self.holidays is None:
+            self.holidays = HolidayCalendar(self.config.holiday_country, self.config.holiday_subdiv)
+        return self.holidays
+
     def get_filtered_habits(self) -> Generator:
         '''
-        creates a generator of filtered habits from those provided in self.config \n
-        this is the ugliest method i've ever written in my life but I can't think of a clearer way to include all the functionality
-        '''
-        holidays = US()
-        # define default values
-        wd = self.current_habit_datetime.isoweekday()
-        is_workday = wd not in [6, 7] and self.current_habit_datetime.strftime(YMD) not in holidays
-        is_1x_week = wd == 3 # W
-        is_2x_week = wd in [2, 4] #  T R
-        is_3x_week = wd in [1, 3, 5] # M W F
-        is_4x_week = wd in [1, 2, 4, 6] # M T R S
-        is_5x_week = wd in [1, 2, 3, 5, 6] # M T W F S
-        is_6x_week = wd != 7 # M T W F S
-
-        for habit in self.config.habits:
-            if habit['status'] != 'On':
-                continue
-            # users can manually set the dates they want otherwise we just use the defaults
-            if 'days' in habit and habit['days']:
-                days: str = habit['days']
-                # this is way more loops than we need but it's pretty and will never have more than 7 members
-                parsed_days = [day.lower() for day in days.replace(' ', '').split(',')]
-                if self.current_habit_datetime.strftime('%A').lower() in parsed_days:
-                    yield habit
-                continue
-            
-            freq = habit['frequency']
-            if freq[0] == 'D': # daily
-                yield habit
-            elif freq[0] == 'W' and is_workday:
-                yield habit
-            elif freq[0] == '1' and is_1x_week:
-                yield habit
-            elif freq[0] == '2' and is_2x_week:
-                yield habit
-            elif freq[0] == '3' and is_3x_week:
-                yield habit
-            elif freq[0] == '4' and is_4x_week:
-                yield habit
-            elif freq[0] == '5' and is_5x_week:
-                yield habit
-            elif freq[0] == '6' and is_6x_week:
-                yield habit
+        creates a generator of filtered habits from those provided in self.config for self.current_habit_datetime
+        '''
+        schedule = self.get_schedule()
+        is_holiday = bool(schedule.workday_habits) and self.current_habit_datetime in self.get_holidays()
+        return schedule.habits_for(schedule.active(self.current_habit_datetime, is_holiday))
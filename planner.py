@@ -0,0 +1,90 @@
+import json
+import threading
+from copy import deepcopy
+import utils
+
+REF_PREFIX = 'plan:'
+
+class PlannedResponse:
+    '''
+    what update_db_page hands back while planning, enough of a requests.Response for our callers
+    '''
+    status_code = 200
+
+    def __init__(self, id):
+        self.id = id
+
+    def json(self):
+        return {'object': 'page', 'id': self.id}
+
+
+class PlanningBridge:
+    '''
+    stands in for Bridge while planning a run. reads still go to notion, but every write is appended to a jsonl plan
+    instead of being sent. pages that would be created get a placeholder id ("plan:<n>") so later records can point
+    at them (habit pages at a new cycle, for example); the executor swaps in the real id once the page exists
+    '''
+    def __init__(self, bridge: utils.Bridge, fp):
+        self.bridge = bridge
+        self.fp = fp
+        self.refs = 0
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.fp.write(json.dumps(record) + '\n')
+
+    def query(self, db_id, body, filter_properties=None):
+        return self.bridge.query(db_id, body, filter_properties)
+
+    def stream(self, db_id, body, **kwargs):
+        return self.bridge.stream(db_id, body, **kwargs)
+
+    def create_db_page(self, db_id, properties, icon, icon_type):
+        with self.lock:
+            self.refs += 1
+            ref = REF_PREFIX + str(self.refs)
+        self.write({'op': 'create', 'ref': ref, 'db_id': db_id, 'properties': properties, 'icon': icon, 'icon_type': icon_type})
+        page = {'object': 'page', 'id': ref, 'properties': deepcopy(properties)}
+        if icon:
+            page['icon'] = {'type': icon_type, icon_type: icon}
+        return page
+
+    def create_page_from_body(self, body):
+        payload = json.loads(body) if isinstance(body, bytes) else body
+        icon = payload.get('icon')
+        return self.create_db_page(payload['parent']['database_id'], payload['properties'], icon[icon['type']] if icon else None, icon['type'] if icon else None)
+
+    def update_db_page(self, properties_to_update, id):
+        self.write({'op': 'update', 'id': id, 'properties': properties_to_update})
+        return PlannedResponse(id)
+
+    def stats(self) -> dict:
+        return self.bridge.stats()
+
+    def close(self):
+        self.bridge.close()
+
+
+def resolve_refs(obj, refs: dict):
+    '''
+    copy of obj with every placeholder id found in refs replaced by the real id
+    '''
+    if isinstance(obj, dict):
+        return {key: resolve_refs(value, refs) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [resolve_refs(value, refs) for value in obj]
+    if isinstance(obj, str) and obj.startswith(REF_PREFIX):
+        if obj not in refs:
+            raise Exception('plan refers to ' + obj + ' before it was created')
+        return refs[obj]
+    return obj
+
+def read_plan(path):
+    '''
+    the records of a plan file, one at a time
+    '''
+    with open(path, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
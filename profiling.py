@@ -0,0 +1,161 @@
+'''
+profiles a run of the job, see daily_job.py --profile:
+
+    python daily_job.py --profile profiles/                                 cProfile, tracemalloc and stack samples
+    python daily_job.py --profile profiles/ --profile-mode sample --profile-rate 0.05    stack samples on 5% of runs
+
+every profile is written to the directory as a handful of files sharing a prefix:
+
+    .pstats             raw cProfile stats, for snakeviz or pstats (full mode)
+    .txt                functions sorted by cumulative and own time (full mode), or by samples (sample mode)
+    .allocations.txt    the lines that allocated the most memory still held at the end of the run (full mode)
+    .collapsed          sampled stacks of every thread, one "frame;frame;frame count" line per stack, for flamegraph.pl
+                        or speedscope
+
+cProfile only sees the thread the run started on, the stack samples also show the bridge's worker threads
+'''
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+FULL = 'full'
+SAMPLE = 'sample'
+MODES = [FULL, SAMPLE]
+# seconds between stack samples. a sample walks every thread's stack, cheap enough at this rate to leave on
+SAMPLE_INTERVAL = 0.01
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 25
+
+def sampled(rate) -> bool:
+    '''
+    whether this run is one of the rate (0 to 1) of runs that get profiled
+    '''
+    return rate >= 1 or random.random() < rate
+
+def get_frame_name(frame) -> str:
+    return os.path.basename(frame.f_code.co_filename) + ':' + frame.f_code.co_name
+
+
+class Sampler:
+    '''
+    counts the stacks of every thread every interval seconds from a background thread
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: dict[str, int] = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample_forever, name='profile-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample_forever(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.get_ident():
+                continue
+            stack = []
+            while frame:
+                stack.append(get_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-' + str(ident)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def collapsed(self) -> list[str]:
+        return [stack + ' ' + str(count) for stack, count in sorted(self.stacks.items())]
+
+    def top(self, n=TOP_FUNCTIONS) -> list[tuple[str, int, int]]:
+        '''
+        (frame, samples it was running in, samples it was on the stack in) of the n frames running the most
+        '''
+        own = {}
+        total = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+        return [(frame, own[frame], total[frame]) for frame in sorted(own, key=own.get, reverse=True)[:n]]
+
+
+class Profiler:
+    '''
+    profiles everything between start and stop. full mode runs cProfile and tracemalloc along with the sampler,
+    which slows the run down noticeably, sample mode only runs the sampler
+    '''
+    def __init__(self, out_dir, mode=FULL, interval=SAMPLE_INTERVAL):
+        if mode not in MODES:
+            raise Exception('unknown profile mode ' + mode + ', expected one of ' + ', '.join(MODES))
+        self.out_dir = out_dir
+        self.mode = mode
+        self.sampler = Sampler(interval)
+        self.profile = None
+        self.started_at = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        print('profile written to ' + self.stop() + '.*')
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        if self.mode == FULL:
+            import cProfile
+            import tracemalloc
+            tracemalloc.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.sampler.start()
+
+    def stop(self) -> str:
+        '''
+        stops profiling and writes out everything collected, returns the prefix shared by the files written
+        '''
+        self.sampler.stop()
+        seconds = time.perf_counter() - self.started_at
+        allocations = None
+        if self.profile:
+            import tracemalloc
+            self.profile.disable()
+            allocations = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, 'profile-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()))
+        with open(prefix + '.collapsed', 'w') as fp:
+            fp.write('\n'.join(self.sampler.collapsed()) + '\n')
+        with open(prefix + '.txt', 'w') as fp:
+            fp.write(self.mode + ' profile of ' + '{:.3f}'.format(seconds) + 's, ' + str(self.sampler.samples) + ' stack samples\n\n')
+            if self.profile:
+                import pstats
+                stats = pstats.Stats(self.profile, stream=fp)
+                stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+                stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+            else:
+                fp.write('{:>8} {:>8}  {}\n'.format('running', 'on stack', 'frame'))
+                for frame, own, total in self.sampler.top():
+                    fp.write('{:>8} {:>8}  {}\n'.format(own, total, frame))
+        if self.profile:
+            self.profile.dump_stats(prefix + '.pstats')
+            with open(prefix + '.allocations.txt', 'w') as fp:
+                for stat in allocations.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    fp.write(str(stat) + '\n')
+        return prefix
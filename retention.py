@@ -0,0 +1,65 @@
+import os
+import threading
+
+RETENTION_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'retention.checkpoint')
+EXPORTED = 'exported'
+ARCHIVED = 'archived'
+# archived cycles matched per tracker query, notion caps the conditions a compound filter can hold
+MAX_CYCLES_PER_QUERY = 50
+
+def get_retention_queries(cutoff: str, cycle_ids: list[str]) -> list[dict]:
+    '''
+    bodies of the tracker queries finding every page dated before cutoff, or related to one of cycle_ids
+    '''
+    queries = []
+    if cutoff:
+        queries.append({'filter': {'property': 'Date', 'date': {'before': cutoff}}})
+    for i in range(0, len(cycle_ids), MAX_CYCLES_PER_QUERY):
+        queries.append({
+            'filter': {
+                'or': [
+                    {
+                        'property': 'Cycle',
+                        'relation': {
+                            'contains': id,
+                        }
+                    } for id in cycle_ids[i:i + MAX_CYCLES_PER_QUERY]
+                ]
+            }
+        })
+    return queries
+
+
+class Checkpoint:
+    '''
+    the tracker pages a retention run has exported and archived so far. every page is appended to path as it's done,
+    so a run that's interrupted picks up where it stopped instead of exporting or archiving a page twice.
+    the file is removed once a run finishes without failures
+    '''
+    def __init__(self, path=RETENTION_PATH):
+        self.path = path
+        self.done = {EXPORTED: set(), ARCHIVED: set()}
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                for line in fp:
+                    state, _, id = line.strip().partition(' ')
+                    if state in self.done:
+                        self.done[state].add(id)
+        self.lock = threading.Lock()
+        self.fp = open(path, 'a')
+
+    def __contains__(self, key: tuple[str, str]):
+        state, id = key
+        return id in self.done[state]
+
+    def mark(self, state, id):
+        with self.lock:
+            self.done[state].add(id)
+            self.fp.write(state + ' ' + id + '\n')
+            self.fp.flush()
+
+    def close(self, finished=False):
+        with self.lock:
+            self.fp.close()
+        if finished:
+            os.remove(self.path)
@@ -0,0 +1,71 @@
+from datetime import datetime
+from typing import Generator, Iterable
+from model import Habit, as_habit
+
+def compile_habit(habit) -> tuple[int, bool]:
+    '''
+    the weekdays a habit is active on and whether it skips holidays
+    '''
+    habit = as_habit(habit)
+    if habit.status != 'On':
+        return 0, False
+    return habit.weekdays, habit.skips_holidays
+
+
+class Schedule:
+    '''
+    a habit list compiled once into one bitmask per weekday, where bit i stands for habits[i].
+    which habits are due on a date is then a single lookup (and a holiday check for workday habits)
+    no matter how many habits there are, and a whole date range is planned in one pass with matrix
+    '''
+    def __init__(self, habits: list):
+        # kept as given so callers can tell when the list is replaced, habits_for hands out the Habit records
+        self.habits = habits
+        self.records: list[Habit] = [as_habit(habit) for habit in habits]
+        self.by_weekday = [0] * 7
+        self.workday_habits = 0
+        self.positions = {}
+        for i, habit in enumerate(self.records):
+            if habit.id:
+                self.positions[habit.id] = i
+            mask, skips_holidays = compile_habit(habit)
+            for day in range(7):
+                if mask >> day & 1:
+                    self.by_weekday[day] |= 1 << i
+            if skips_holidays:
+                self.workday_habits |= 1 << i
+
+    def mask_of(self, ids) -> int:
+        '''
+        bitmask of the habits with the given ids, unknown ids are ignored
+        '''
+        mask = 0
+        for id in ids:
+            if id in self.positions:
+                mask |= 1 << self.positions[id]
+        return mask
+
+    def active(self, date: datetime, is_holiday=False) -> int:
+        '''
+        bitmask of the habits due on date
+        '''
+        mask = self.by_weekday[date.weekday()]
+        return mask & ~self.workday_habits if is_holiday else mask
+
+    def matrix(self, dates: Iterable[datetime], holidays=()) -> list[int]:
+        '''
+        the date x habit activation matrix for dates, one row bitmask per date. holidays is anything supporting "in"
+        and is only consulted when there are workday habits
+        '''
+        if not self.workday_habits:
+            return [self.by_weekday[date.weekday()] for date in dates]
+        return [self.active(date, date in holidays) for date in dates]
+
+    def habits_for(self, mask: int) -> Generator:
+        '''
+        the habits whose bits are set in mask, in catalog order
+        '''
+        while mask:
+            lowest = mask & -mask
+            yield self.records[lowest.bit_length() - 1]
+            mask ^= lowest
@@ -0,0 +1,34 @@
+import json
+import re
+import utils
+
+# stand-ins for the per page values while a template is serialized. the NUL characters can't appear in anything
+# notion sends us, so the encoded slots can't collide with a habit's name
+DATE_SLOT = '\x00date\x00'
+CYCLE_SLOT = '\x00cycle\x00'
+ENCODED_SLOTS = {json.dumps(slot).encode(): slot for slot in [DATE_SLOT, CYCLE_SLOT]}
+SLOT_PATTERN = re.compile(b'(' + b'|'.join(re.escape(slot) for slot in ENCODED_SLOTS) + b')')
+# properties whose values are the same as an empty tracker page's, so sending them changes nothing
+DEFAULT_PROPERTIES = ['Progress', 'Neutral', 'Setback Notes']
+
+
+class PageTemplate:
+    '''
+    the complete create request for one habit's tracker pages, serialized once per run and kept as byte fragments
+    around the date and cycle id. rendering a page is then a join of bytes instead of building and encoding the payload
+    '''
+    def __init__(self, habit, db_id, properties: dict):
+        self.habit = habit
+        encoded = json.dumps(utils.get_page_payload(db_id, properties, habit['icon'], habit['icon_type'])).encode()
+        # splitting on a capturing group alternates fragments and the slots found between them
+        parts = SLOT_PATTERN.split(encoded)
+        self.fragments = parts[0::2]
+        self.slots = [ENCODED_SLOTS[slot] for slot in parts[1::2]]
+
+    def render(self, date: str, cycle_id: str) -> bytes:
+        values = {DATE_SLOT: json.dumps(date).encode(), CYCLE_SLOT: json.dumps(cycle_id).encode()}
+        body = [self.fragments[0]]
+        for slot, fragment in zip(self.slots, self.fragments[1:]):
+            body.append(values[slot])
+            body.append(fragment)
+        return b''.join(body)
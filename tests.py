@@ -1,8 +1,24 @@
 
+import asyncio
+import json
+import marshal
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from freezegun import freeze_time
 from notion import Notion
-from datetime import datetime
+from datetime import datetime, timedelta
+import config, utils
+from cycles import CycleCalendar, CycleIndex
+from metrics import Histogram
+from schedule import Schedule
+from model import Habit
+import analytics, benchmarks, cassette, daemon, fleet, profiling, retention, workdays
+from workdays import HolidayCalendar
 # from the time writing this - only the days of the week are important
 monday = '2023-04-10'
 tuesday = '2023-04-11'
@@ -12,9 +28,14 @@ friday = '2023-04-14'
 saturday = '2023-04-15'
 sunday = '2023-04-16'
 YMD = '%Y-%m-%d'
+# the tests never read or write the config.json next to the job, every Notion is built from this one
+TEST_CONFIG_DIR = tempfile.TemporaryDirectory()
+TEST_CONFIG_PATH = os.path.join(TEST_CONFIG_DIR.name, 'config.json')
+with open(TEST_CONFIG_PATH, 'w') as fp:
+    json.dump({'api_key': 'secret_test', 'habit_tracker_db_id': 'tracker', 'cycles_db_id': 'cycles', 'new_cycle_dates': [1], 'habits_db': 'habits', 'job_frequency': '0', 'habits': []}, fp)
 
 class TestNotion(unittest.TestCase):
-    notion = Notion()
+    notion = Notion(TEST_CONFIG_PATH)
     dow_types = ['6x Week', '5x Week', '4x Week', '3x Week', '2x Week', '1x Week', 'Daily', 'Workday']
     habits = [
         {
@@ -236,6 +257,1186 @@ class TestNotion(unittest.TestCase):
         habits = list(self.notion.get_filtered_habits())
         test_valid_dates(self, valid, habits)
 
+class FakeResponse:
+    def __init__(self, body=None, status_code=200, headers=None):
+        self.body = body if body is not None else {}
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    @property
+    def content(self):
+        return json.dumps(self.body).encode()
+
+class FakeSession:
+    '''
+    stands in for requests.Session, recording every call and answering with queued responses
+    '''
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.calls = []
+        self.headers = {}
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        self.calls.append((method, url, data))
+        return self.responses.pop(0) if self.responses else FakeResponse({'id': 'page-' + str(len(self.calls))})
+
+    def close(self):
+        pass
+
+class RaisingSession(FakeSession):
+    '''
+    a FakeSession whose queued exceptions are raised instead of returned
+    '''
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        response = super().request(method, url, data, timeout)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class FakeClock:
+    '''
+    a clock that only moves when something sleeps on it
+    '''
+    def __init__(self):
+        self.now = 0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+def unlimited() -> utils.RateLimiter:
+    return utils.RateLimiter(10 ** 9, 10 ** 9)
+
+def fake_bridge(responses=None, **kwargs) -> utils.Bridge:
+    if 'limiter' not in kwargs:
+        kwargs['limiter'] = unlimited()
+    bridge = utils.Bridge('secret_test', **kwargs)
+    bridge.session = FakeSession(responses)
+    return bridge
+
+class TestBridge(unittest.TestCase):
+    def test_session_pool_configured(self):
+        bridge = utils.Bridge('secret_test', pool_size=3, connect_timeout=1, read_timeout=2)
+        self.assertIsNone(bridge.session)
+        session = bridge.get_session()
+        self.assertEqual(bridge.adapter._pool_maxsize, 3)
+        self.assertEqual(bridge.timeout, (1, 2))
+        self.assertEqual(session.headers['Authorization'], 'Bearer secret_test')
+        bridge.close()
+
+    def test_stats_counts_reused_connections(self):
+        bridge = fake_bridge()
+        bridge.connections_opened = lambda: 1
+        for _ in range(3):
+            bridge.query('db', {})
+        bridge.create_db_page('db', {}, None, None)
+        stats = bridge.stats()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['connections_opened'], 1)
+        self.assertEqual(stats['connections_reused'], 3)
+
+    def test_retries_after_rate_limit(self):
+        clock = FakeClock()
+        limiter = utils.RateLimiter(3, 3, clock, clock.sleep)
+        bridge = fake_bridge([FakeResponse({}, 429, {'Retry-After': '2'}), FakeResponse({'results': []})], limiter=limiter)
+        self.assertEqual(bridge.query('db', {}).status_code, 200)
+        self.assertEqual(bridge.stats()['retries'], 1)
+        # the retry waited out Retry-After before going out again
+        self.assertGreaterEqual(clock.now, 2)
+        self.assertGreaterEqual(bridge.stats()['throttled_seconds'], 2)
+
+    def test_create_raises_when_rate_limit_persists(self):
+        clock = FakeClock()
+        limiter = utils.RateLimiter(3, 3, clock, clock.sleep)
+        bridge = fake_bridge([FakeResponse({}, 429, {'Retry-After': '1'}) for _ in range(3)], limiter=limiter, max_retries=2)
+        with self.assertRaises(Exception):
+            bridge.create_db_page('db', {}, None, None)
+        self.assertEqual(len(bridge.session.calls), 3)
+
+    def test_server_errors_are_retried(self):
+        bridge = fake_bridge([FakeResponse({}, 502), FakeResponse({'results': []}), FakeResponse({}, 504), FakeResponse({'id': 'page'})])
+        bridge.limiter.sleep = lambda _: None
+        self.assertEqual(bridge.query('db', {}).status_code, 200)
+        self.assertEqual(bridge.update_db_page({}, 'page').status_code, 200)
+        self.assertEqual(len(bridge.session.calls), 4)
+
+    def test_page_creation_is_not_repeated(self):
+        import requests
+        from urllib3.exceptions import MaxRetryError, NewConnectionError
+        # the page may exist already after a gateway or read timeout, so only failures before sending anything are retried
+        bridge = fake_bridge([FakeResponse({'object': 'error'}, 504), requests.ReadTimeout(), requests.ConnectTimeout(), requests.ConnectionError(MaxRetryError(None, 'url', NewConnectionError(None, 'refused'))), FakeResponse({'id': 'page'})])
+        bridge.session = RaisingSession(bridge.session.responses)
+        bridge.limiter.sleep = lambda _: None
+        self.assertNotIn('id', bridge.create_db_page('db', {}, None, None))
+        with self.assertRaises(requests.ReadTimeout):
+            bridge.create_db_page('db', {}, None, None)
+        self.assertEqual(bridge.create_db_page('db', {}, None, None)['id'], 'page')
+        self.assertEqual(len(bridge.session.calls), 5)
+
+def result_pages(*pages):
+    '''
+    query responses chained together with cursors, one per list of result ids
+    '''
+    return [FakeResponse({
+        'results': [{'id': id} for id in page],
+        'has_more': i < len(pages) - 1,
+        'next_cursor': 'cursor-' + str(i + 1) if i < len(pages) - 1 else None,
+    }) for i, page in enumerate(pages)]
+
+class TestStream(unittest.TestCase):
+    def test_follows_cursors(self):
+        bridge = fake_bridge(result_pages(['a', 'b'], ['c'], ['d']))
+        ids = [r['id'] for r in bridge.stream('db', {'filter': {}}, page_size=2)]
+        self.assertListEqual(ids, ['a', 'b', 'c', 'd'])
+        bodies = [json.loads(call[2]) for call in bridge.session.calls]
+        self.assertListEqual([body.get('start_cursor') for body in bodies], [None, 'cursor-1', 'cursor-2'])
+        self.assertTrue(all(body['page_size'] == 2 and 'filter' in body for body in bodies))
+
+    def test_pages_are_pulled_lazily(self):
+        bridge = fake_bridge(result_pages(['a', 'b'], ['c']))
+        for r in bridge.stream('db', {}):
+            break
+        self.assertEqual(len(bridge.session.calls), 1)
+
+    def test_prefetch_yields_same_results(self):
+        bridge = fake_bridge(result_pages(['a'], ['b'], ['c']))
+        ids = [r['id'] for r in bridge.stream('db', {}, prefetch=True)]
+        self.assertListEqual(ids, ['a', 'b', 'c'])
+
+    def test_filter_properties(self):
+        bridge = fake_bridge(result_pages(['a']))
+        list(bridge.stream('db', {}, filter_properties=['title', 'Date']))
+        self.assertTrue(bridge.session.calls[0][1].endswith('/query?filter_properties=title&filter_properties=Date'))
+
+def habit_page(name, frequency='Daily'):
+    return {
+        'id': name + '-id',
+        'properties': {
+            'Name': {'title': [{'plain_text': name}]},
+            'Frequency': {'select': {'name': frequency}},
+            'Status': {'select': {'name': 'On'}},
+        },
+    }
+
+class TestLoadHabits(unittest.TestCase):
+    def test_loads_every_page(self):
+        generator = config.ConfigGenerator(TEST_CONFIG_PATH)
+        generator.config = {'habits_db': 'habits'}
+        generator.habits = []
+        first, second = result_pages(['x'], ['y'])
+        first.body['results'] = [habit_page('Read'), habit_page('Run')]
+        second.body['results'] = [habit_page('Stretch')]
+        generator.bridge = fake_bridge([first, second])
+        generator.load_habits()
+        self.assertListEqual([habit['name'] for habit in generator.config['habits']], ['Read', 'Run', 'Stretch'])
+
+class TestSyncHabits(unittest.TestCase):
+    def get_generator(self, *pages, **config_values):
+        generator = config.ConfigGenerator(TEST_CONFIG_PATH)
+        generator.config = dict({'habits_db': 'habits'}, **config_values)
+        generator.habits = []
+        responses = []
+        for results in pages:
+            response = result_pages([])[0]
+            response.body['results'] = results
+            responses.append(response)
+        generator.bridge = fake_bridge(responses)
+        return generator
+
+    def synced(self, minutes_ago=0, full_days_ago=0) -> dict:
+        now = datetime.now(config.timezone.utc)
+        return {
+            'habits_synced_at': (now - timedelta(minutes=minutes_ago)).isoformat(),
+            'habits_full_synced_at': (now - timedelta(days=full_days_ago)).isoformat(),
+        }
+
+    def test_first_sync_loads_everything(self):
+        generator = self.get_generator([habit_page('Read'), habit_page('Run')])
+        generator.sync_habits()
+        self.assertListEqual([habit['name'] for habit in generator.config['habits']], ['Read', 'Run'])
+        self.assertNotIn('filter', json.loads(generator.bridge.session.calls[0][2]))
+        self.assertIn('habits_synced_at', generator.config)
+
+    def test_merges_edited_habits(self):
+        edited = habit_page('Run', '3x Week')
+        removed = habit_page('Stretch')
+        removed['archived'] = True
+        generator = self.get_generator([edited, removed, habit_page('Swim')], habits=[daily_habit('Read'), daily_habit('Run'), daily_habit('Stretch')], **self.synced(minutes_ago=60))
+        generator.sync_habits()
+        self.assertListEqual([(habit['name'], habit['frequency']) for habit in generator.config['habits']], [('Read', 'Daily'), ('Run', '3x Week'), ('Swim', 'Daily')])
+        body = json.loads(generator.bridge.session.calls[0][2])
+        self.assertEqual(body['filter']['timestamp'], 'last_edited_time')
+
+    def test_ttl_skips_query(self):
+        generator = self.get_generator(habits=[daily_habit('Read')], **self.synced(minutes_ago=5))
+        generator.sync_habits(ttl=3600)
+        self.assertEqual(len(generator.bridge.session.calls), 0)
+        self.assertEqual(len(generator.config['habits']), 1)
+
+    def test_stale_catalog_is_reloaded(self):
+        generator = self.get_generator([habit_page('Run')], habits=[daily_habit('Read')], **self.synced(full_days_ago=8))
+        generator.sync_habits()
+        self.assertListEqual([habit['name'] for habit in generator.config['habits']], ['Run'])
+
+    def test_failed_sync_keeps_cache(self):
+        synced = self.synced(minutes_ago=60)
+        generator = self.get_generator(habits=[daily_habit('Read')], **synced)
+        generator.bridge = fake_bridge([FakeResponse({'message': 'unauthorized'}, 401)])
+        generator.sync_habits()
+        self.assertEqual(len(generator.config['habits']), 1)
+        self.assertEqual(generator.config['habits_synced_at'], synced['habits_synced_at'])
+
+    def test_run_uses_synced_habits(self):
+        notion = fake_notion([], [])
+        notion.generator.config.update(habits=[daily_habit('Read')], **self.synced(minutes_ago=5))
+        notion.config.habits_ttl = 3600
+        notion.sync_habits()
+        self.assertListEqual([habit['name'] for habit in notion.config.habits], ['Read'])
+
+    def test_sync_keeps_config_edits(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'config.json')
+            with open(TEST_CONFIG_PATH, 'r') as fp:
+                values = json.load(fp)
+            with open(path, 'w') as fp:
+                json.dump(values, fp)
+            notion = Notion(path)
+            response = result_pages([])[0]
+            response.body['results'] = [habit_page('Read')]
+            notion.generator.bridge = fake_bridge([response])
+            # edited while the notion is loaded, as a daemon would hold it
+            with open(path, 'w') as fp:
+                json.dump(dict(values, new_cycle_dates=[1, 15], tenant='edited'), fp)
+            notion.sync_habits()
+            with open(path, 'r') as fp:
+                saved = json.load(fp)
+            self.assertListEqual([habit['name'] for habit in saved['habits']], ['Read'])
+            self.assertIn('habits_synced_at', saved)
+            self.assertListEqual(saved['new_cycle_dates'], [1, 15])
+            self.assertEqual(saved['tenant'], 'edited')
+
+def cycle_page(id, start, end, status='Upcoming'):
+    return {
+        'id': id,
+        'properties': {
+            'Date Range': {'date': {'start': start, 'end': end}},
+            'Status': {'select': {'name': status}},
+        },
+    }
+
+class TestHabit(unittest.TestCase):
+    def test_precompiled_and_compact(self):
+        habit = Habit.from_dict({'name': 'Read', 'frequency': 'Workday', 'id': 'Read-id', 'icon': None, 'icon_type': None, 'status': 'On', 'days': None})
+        self.assertEqual((habit.weekdays, habit.skips_holidays), (0b11111, True))
+        self.assertEqual(Habit('Run', '3x Week', days='Monday, Sunday').weekdays, 0b1000001)
+        self.assertFalse(hasattr(habit, '__dict__'))
+        self.assertIs(Habit.from_dict({'name': ''.join(['Re', 'ad'])}).name, habit.name)
+        self.assertEqual(habit['name'], 'Read')
+        self.assertEqual(habit, {'name': 'Read', 'frequency': 'Workday', 'id': 'Read-id', 'status': 'On'})
+
+    def test_config_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'config.json')
+            habits = [daily_habit('Read'), dict(daily_habit('Run'), days='Tuesday')]
+            config.save_config(path, {'habits': [Habit.from_dict(habit) for habit in habits]}, snapshot=True)
+            with open(path) as fp:
+                self.assertListEqual(json.load(fp)['habits'], habits)
+            for snapshot in [False, True]:
+                loaded = config.load_config(path, snapshot)['habits']
+                self.assertTrue(all(isinstance(habit, Habit) for habit in loaded))
+                self.assertListEqual([habit.to_dict() for habit in loaded], habits)
+
+    def test_failed_save_keeps_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'config.json')
+            config.save_config(path, {'habits': [daily_habit('Read')]})
+            with self.assertRaises(TypeError):
+                config.save_config(path, {'habits': [daily_habit('Run')], 'tenant': object()})
+            self.assertListEqual(config.load_config(path)['habits'], [daily_habit('Read')])
+
+    def test_external_and_file_icons(self):
+        external = dict(habit_page('Read'), icon={'type': 'external', 'external': {'url': 'https://example.com/read.png'}})
+        file = dict(habit_page('Run'), icon={'type': 'file', 'file': {'url': 'https://example.com/run.png', 'expiry_time': '2023-04-10T00:00:00.000Z'}})
+        habits = [config.ConfigGenerator(TEST_CONFIG_PATH).get_habit(page) for page in [external, file]]
+        self.assertListEqual([(habit.icon, habit.icon_type) for habit in habits], [({'url': 'https://example.com/read.png'}, 'external'), ({'url': 'https://example.com/run.png'}, 'external')])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'config.json')
+            with open(path, 'w') as fp:
+                json.dump({'habits': [habit.to_dict() for habit in habits]}, fp)
+            for snapshot in [False, True]:
+                loaded = config.load_config(path, snapshot)['habits']
+                self.assertListEqual([habit.to_dict() for habit in loaded], [habit.to_dict() for habit in habits])
+            config.save_config(path, {'habits': loaded}, snapshot=True)
+            self.assertListEqual([habit.to_dict() for habit in config.load_config(path, snapshot=True)['habits']], [habit.to_dict() for habit in habits])
+
+class TestCycleIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = CycleIndex([
+            cycle_page('may', '2023-05-01', '2023-06-01'),
+            cycle_page('april', '2023-04-01', '2023-05-01', 'Active'),
+            cycle_page('march', '2023-03-01', '2023-04-01', 'Archive'),
+        ])
+
+    def test_closed_cycles_are_not_indexed(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertIsNone(self.index.containing('2023-03-15'))
+
+    def test_containing(self):
+        self.assertEqual(self.index.containing('2023-04-01')['id'], 'april')
+        self.assertEqual(self.index.containing('2023-04-30')['id'], 'april')
+        # end dates are exclusive
+        self.assertEqual(self.index.containing('2023-05-01')['id'], 'may')
+        self.assertIsNone(self.index.containing('2023-06-01'))
+
+    def test_status_changes_are_folded_in(self):
+        self.assertEqual(self.index.active()['id'], 'april')
+        self.index.set_status('april', 'Archive')
+        self.index.set_status('may', 'Active')
+        self.assertEqual(self.index.active()['id'], 'may')
+        self.assertListEqual(self.index.upcoming(), [])
+        self.assertIsNone(self.index.containing('2023-04-15'))
+
+    def test_added_cycles_are_found(self):
+        self.index.add(cycle_page('june', '2023-06-01', '2023-07-01'))
+        self.assertEqual(self.index.containing('2023-06-10')['id'], 'june')
+        self.assertListEqual([cycle['id'] for cycle in self.index.upcoming()], ['may', 'june'])
+
+    def test_cycles_are_queried_once_per_run(self):
+        notion = fake_notion(responses=[FakeResponse({'results': [cycle_page('april', '2023-04-01', '2023-05-01', 'Active')]})])
+        for date in [monday, tuesday, wednesday]:
+            notion.current_habit_datetime = datetime.fromisoformat(date)
+            self.assertEqual(notion.get_period_cycle()['id'], 'april')
+        self.assertEqual(notion.get_active_cycle()['id'], 'april')
+        self.assertIsNone(notion.get_upcoming_cycles())
+        self.assertEqual(len(notion.bridge.session.calls), 1)
+
+class TestCycleCalendar(unittest.TestCase):
+    def test_containing(self):
+        calendar = CycleCalendar([15, 1])
+        self.assertTupleEqual(calendar.containing(datetime.fromisoformat('2023-04-10 18:30')), (datetime(2023, 4, 1), datetime(2023, 4, 15), 1))
+        self.assertTupleEqual(calendar.containing(datetime.fromisoformat('2023-12-20')), (datetime(2023, 12, 15), datetime(2024, 1, 1), 0))
+        # far outside the horizon it's worked out again around the date
+        self.assertTupleEqual(calendar.containing(datetime.fromisoformat('2030-01-01')), (datetime(2030, 1, 1), datetime(2030, 1, 15), 1))
+        self.assertTupleEqual(calendar.containing(datetime.fromisoformat('2023-04-15')), (datetime(2023, 4, 15), datetime(2023, 5, 1), 0))
+
+    def test_periods(self):
+        periods = CycleCalendar([1]).periods(datetime.fromisoformat('2023-04-10'), datetime.fromisoformat('2023-06-01'))
+        self.assertListEqual([start.strftime(YMD) for start, _, _ in periods], ['2023-04-01', '2023-05-01', '2023-06-01'])
+
+    def test_cyclic_run_creates_habits_until_next_cycle(self):
+        notion = fake_notion([daily_habit('Read')], new_cycle_dates=[1, 15], job_frequency='3', concurrency=1)
+        notion.run_date = datetime.fromisoformat(monday)
+        notion.get_current_cycle_id = lambda: 'cycle'
+        notion.create_habits()
+        dates = [json.loads(call[2])['properties']['Date']['date']['start'] for call in notion.bridge.session.calls]
+        self.assertListEqual(dates, [monday, tuesday, wednesday, thursday, friday])
+
+class GatedSession(FakeSession):
+    '''
+    holds every status update until a page is created, so a run that waits on its updates before creating the cycle hangs
+    '''
+    def __init__(self, responses=None):
+        super().__init__(responses)
+        self.created = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        if method == 'POST' and not url.endswith('/query'):
+            self.created.set()
+        if method == 'PATCH':
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.created.wait(5)
+            with self.lock:
+                self.in_flight -= 1
+        return super().request(method, url, data, timeout)
+
+class TestCycleTransitions(unittest.TestCase):
+    def setUp(self):
+        self.notion = fake_notion(new_cycle_dates=[1], concurrency=4)
+        self.notion.run_date = self.notion.current_habit_datetime = datetime.fromisoformat('2023-05-01')
+        self.notion.bridge.session = GatedSession([FakeResponse({'results': [
+            cycle_page('april', '2023-04-01', '2023-05-01', 'Active'),
+            cycle_page('short', '2023-05-01', '2023-05-15'),
+            cycle_page('long', '2023-05-01', '2023-05-20'),
+        ]})])
+
+    def test_new_cycle_does_not_wait_on_transitions(self):
+        self.notion.create_cycle()
+        self.assertTrue(self.notion.bridge.session.created.is_set())
+        self.assertEqual(self.notion.finish_cycle_transitions(), 0)
+        updates = {call[1].split('/')[-1]: json.loads(call[2])['properties']['Status']['select']['name'] for call in self.notion.bridge.session.calls if call[0] == 'PATCH'}
+        self.assertDictEqual(updates, {'april': 'Archive', 'short': 'Error', 'long': 'Error'})
+        self.assertGreater(self.notion.bridge.session.max_in_flight, 1)
+
+    def test_cycles_already_in_state_are_skipped(self):
+        self.notion.bridge.session.created.set()
+        self.notion.transition_cycles({'april': 'Active', 'short': 'Upcoming', 'long': 'Error'})
+        self.notion.transition_cycles({'long': 'Error'})
+        self.assertEqual(self.notion.finish_cycle_transitions(), 0)
+        self.assertListEqual([call[1].split('/')[-1] for call in self.notion.bridge.session.calls if call[0] == 'PATCH'], ['long'])
+
+class TestSchedule(unittest.TestCase):
+    def test_matrix_matches_filtered_habits(self):
+        schedule = Schedule(TestNotion.habits)
+        dates = [datetime.fromisoformat('2022-06-27') + timedelta(days=i) for i in range(14)] # includes july 4th
+        notion = fake_notion(TestNotion.habits)
+        rows = schedule.matrix(dates, notion.get_holidays())
+        for date, row in zip(dates, rows):
+            notion.current_habit_datetime = date
+            self.assertListEqual(list(schedule.habits_for(row)), list(notion.get_filtered_habits()))
+
+    def test_days_override_frequency(self):
+        schedule = Schedule([{'name': 'a', 'frequency': 'Daily', 'status': 'On', 'days': 'tuesday,Sunday'}])
+        self.assertListEqual([bool(row) for row in schedule.matrix([datetime.fromisoformat(day) for day in [monday, tuesday, sunday]])], [False, True, True])
+
+    def test_habits_keep_catalog_order(self):
+        habits = [daily_habit(str(i)) for i in range(200)]
+        schedule = Schedule(habits)
+        self.assertListEqual(list(schedule.habits_for(schedule.active(datetime.fromisoformat(monday)))), habits)
+
+    def test_plan_habits(self):
+        notion = fake_notion(TestNotion.habits)
+        plan = notion.plan_habits([saturday, sunday])
+        self.assertListEqual([date for date, _ in plan], [saturday, sunday])
+        self.assertListEqual([habit['name'] for habit in notion.schedule.habits_for(plan[1][1])], ['Daily'])
+
+class TestHolidayCalendar(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_lookups(self):
+        calendar = HolidayCalendar('US', None, self.cache_dir.name)
+        self.assertIn(datetime.fromisoformat('2022-07-04'), calendar)
+        self.assertIn('2022-12-26', calendar) # christmas observed
+        self.assertNotIn(datetime.fromisoformat(monday), calendar)
+
+    def test_subdivision(self):
+        calendar = HolidayCalendar('US', 'MA', self.cache_dir.name)
+        self.assertIn('2023-04-17', calendar) # patriots' day
+        self.assertNotIn('2023-04-17', HolidayCalendar('US', None, self.cache_dir.name))
+
+    def test_years_are_cached_on_disk(self):
+        HolidayCalendar('US', None, self.cache_dir.name).prepare([datetime.fromisoformat(monday)])
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir.name, 'holidays-US-2023.json')))
+        compute_holidays = workdays.compute_holidays
+        def fail(*_):
+            raise AssertionError('holidays should come from the cache')
+        workdays.compute_holidays = fail
+        try:
+            self.assertIn('2023-07-04', HolidayCalendar('US', None, self.cache_dir.name))
+        finally:
+            workdays.compute_holidays = compute_holidays
+
+    def test_not_loaded_without_workday_habits(self):
+        notion = fake_notion([daily_habit('Read')])
+        notion.plan_habits([monday, tuesday])
+        self.assertIsNone(notion.holidays)
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.notion = fake_notion([daily_habit('Read'), daily_habit('Run')], concurrency=1)
+        self.notion.get_current_cycle_id = lambda: 'cycle'
+
+    def test_rerun_skips_created_pages(self):
+        self.notion.create_habits_for_dates([monday, tuesday])
+        self.assertEqual(len(self.notion.bridge.session.calls), 4)
+        self.notion.get_current_cycle_id = lambda: self.fail('finished dates should not resolve a cycle')
+        self.notion.create_habits_for_dates([monday, tuesday])
+        self.assertEqual(len(self.notion.bridge.session.calls), 4)
+
+    def test_resumes_missing_pages(self):
+        self.notion.bridge.session.responses = [FakeResponse({'id': 'a'}), FakeResponse({'object': 'error', 'status': 500}, 400)]
+        self.notion.create_habits_for_dates([monday])
+        self.assertSetEqual(self.notion.ledger.created(self.notion.config.habit_tracker_db_id, [monday])[monday], {'Read-id'})
+        self.notion.config.concurrency = 4
+        self.notion.create_habits_for_dates([monday, tuesday])
+        names = [json.loads(call[2])['properties']['Name']['title'][0]['text']['content'] for call in self.notion.bridge.session.calls[2:]]
+        self.assertListEqual(sorted(names), ['Read', 'Run', 'Run'])
+
+    def test_pending_pages_are_not_created(self):
+        ledger = self.notion.get_ledger()
+        ledger.journal('db', monday, ['Read-id'])
+        self.assertSetEqual(ledger.created('db', [monday])[monday], set())
+        ledger.mark_done('db', monday, 'Read-id', 'page')
+        ledger.journal('db', monday, ['Read-id'])
+        self.assertSetEqual(ledger.created('db', [monday])[monday], {'Read-id'})
+
+    @freeze_time('2023-05-01')
+    def test_rerun_reuses_todays_cycle(self):
+        notion = fake_notion(responses=[FakeResponse({'results': [cycle_page('may', '2023-05-01', '2023-06-01', 'Active')]})], new_cycle_dates=[1])
+        notion.current_habit_datetime = datetime.now()
+        self.assertEqual(notion.get_current_cycle_id(), 'may')
+        self.assertEqual(len(notion.bridge.session.calls), 1)
+
+    def test_compact(self):
+        ledger = self.notion.get_ledger()
+        ledger.mark_done('db', '2000-01-01', 'Read-id', 'page')
+        ledger.mark_done('db', datetime.now().strftime(YMD), 'Read-id', 'page')
+        self.assertEqual(ledger.compact(30), 1)
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'plan.jsonl')
+
+    @freeze_time(monday)
+    def test_plan_then_execute(self):
+        habits = [daily_habit('Read'), daily_habit('Run')]
+        habits_query = result_pages([])[0]
+        habits_query.body['results'] = [habit_page('Read'), habit_page('Run')]
+        notion = fake_notion([], [habits_query] + result_pages([]), new_cycle_dates=[1], job_frequency='1', concurrency=4)
+        notion.generator.habits = []
+        notion.plan(self.path)
+        # planning only reads
+        self.assertListEqual([call[1].endswith('/query') for call in notion.bridge.session.calls], [True, True])
+        records = [json.loads(line) for line in open(self.path)]
+        self.assertEqual(len(records), 15)
+        self.assertEqual(records[0]['db_id'], notion.config.cycles_db_id)
+        self.assertEqual(records[0]['properties']['Date Range']['date'], {'start': monday, 'end': '2023-05-01'})
+        self.assertTrue(all(record['properties']['Cycle']['relation'][0]['id'] == records[0]['ref'] for record in records[1:]))
+
+        executor = fake_notion(habits, concurrency=4)
+        executor.execute_plan(self.path)
+        # the cycle index is looked up before the cycle is created
+        query, *calls = executor.bridge.session.calls
+        self.assertTrue(query[1].endswith('/query'))
+        self.assertEqual(len(calls), 15)
+        cycle_id = 'page-2'
+        self.assertIn('Date Range', json.loads(calls[0][2])['properties'])
+        self.assertTrue(all(json.loads(call[2])['properties']['Cycle']['relation'][0]['id'] == cycle_id for call in calls[1:]))
+
+    def test_execute_skips_created_pages(self):
+        habits = [daily_habit('Read')]
+        properties = fake_notion(habits).get_habit_properties(habits[0], 'cycle')
+        with open(self.path, 'w') as fp:
+            fp.write(json.dumps({'op': 'create', 'ref': 'plan:1', 'db_id': 'tracker', 'properties': properties, 'icon': None, 'icon_type': None}) + '\n')
+        executor = fake_notion(habits, habit_tracker_db_id='tracker')
+        ledger = executor.get_ledger()
+        ledger.mark_done('tracker', properties['Date']['date']['start'], 'Read-id', 'page')
+        executor.close = lambda: None
+        executor.execute_plan(self.path)
+        self.assertEqual(len(executor.bridge.session.calls), 0)
+
+    def test_execute_again_reuses_created_cycle(self):
+        habits = [daily_habit('Read')]
+        properties = fake_notion(habits).get_habit_properties(habits[0], 'plan:1')
+        with open(self.path, 'w') as fp:
+            fp.write(json.dumps({'op': 'create', 'ref': 'plan:1', 'db_id': 'cycles', 'properties': cycle_page(None, monday, '2023-05-01')['properties'], 'icon': None, 'icon_type': None}) + '\n')
+            fp.write(json.dumps({'op': 'create', 'ref': 'plan:2', 'db_id': 'tracker', 'properties': properties, 'icon': None, 'icon_type': None}) + '\n')
+        cycles_query = result_pages([])[0]
+        # activated by the first execution since
+        cycles_query.body['results'] = [cycle_page('created', monday, '2023-05-01', 'Active')]
+        executor = fake_notion(habits, [cycles_query], habit_tracker_db_id='tracker', cycles_db_id='cycles')
+        executor.execute_plan(self.path)
+        _, *calls = executor.bridge.session.calls
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(json.loads(calls[0][2])['properties']['Cycle']['relation'][0]['id'], 'created')
+
+class EchoSession(FakeSession):
+    '''
+    answers queries with no results and creates and updates with the page as sent, once the queued responses run out
+    '''
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        if self.responses:
+            return super().request(method, url, data, timeout)
+        self.calls.append((method, url, data))
+        if '/query' in url:
+            return FakeResponse({'results': [], 'has_more': False, 'next_cursor': None})
+        return FakeResponse(dict(json.loads(data), object='page', id='page-' + str(len(self.calls))))
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'run.cassette.jsonl')
+
+    def record(self, job_frequency) -> list:
+        habits_query = result_pages([])[0]
+        habits_query.body['results'] = [habit_page('Read'), habit_page('Run', 'Workday')]
+        notion = fake_notion([], new_cycle_dates=[1, 15], job_frequency=job_frequency, concurrency=4)
+        notion.bridge.session = EchoSession([habits_query])
+        notion.run_date = datetime.fromisoformat(monday)
+        notion.use_cassette(self.path, 'record')
+        notion.run()
+        return notion.bridge.session.session.calls
+
+    def test_runs_replay_offline(self):
+        for job_frequency in ['1', '2', '3']:
+            with self.subTest(job_frequency=job_frequency):
+                recorded = self.record(job_frequency)
+                notion = fake_notion([], new_cycle_dates=[1, 15], job_frequency=job_frequency, concurrency=4)
+                notion.use_cassette(self.path, 'replay')
+                replayed = []
+                request = notion.bridge.session.request
+                def record_call(method, url, data=None, **kwargs):
+                    replayed.append((method, url, data))
+                    return request(method, url, data, **kwargs)
+                notion.bridge.session.request = record_call
+                notion.run()
+                self.assertEqual(notion.run_date, datetime.fromisoformat(monday))
+                self.assertEqual(notion.bridge.session.unserved(), 0)
+                self.assertCountEqual(replayed, recorded)
+
+    def test_latency_and_misses(self):
+        with open(self.path, 'w') as fp:
+            fp.write(json.dumps({'cassette': 1, 'run_date': monday}) + '\n')
+            for url in ['query_url/query', 'pages_url']:
+                fp.write(json.dumps({'key': cassette.get_key('POST', url, b'{}'), 'method': 'POST', 'url': url, 'request': '{}', 'status_code': 200, 'response': '{"id": "a"}', 'seconds': 0.2}) + '\n')
+        slept = []
+        session = cassette.ReplaySession(self.path, 0.25, slept.append)
+        self.assertEqual(session.request('POST', 'query_url/query', b'{"changed": true}').json(), {'id': 'a'})
+        self.assertListEqual(slept, [0.25])
+        with self.assertRaises(Exception):
+            session.request('POST', 'query_url/query', b'{"changed": true}')
+        # a write with a different body than recorded is never answered with another page
+        with self.assertRaises(Exception):
+            session.request('POST', 'pages_url', b'{"changed": true}')
+        self.assertEqual(session.request('POST', 'pages_url', b'{}').json(), {'id': 'a'})
+
+class TestPageTemplate(unittest.TestCase):
+    def test_render_matches_full_payload(self):
+        habit = daily_habit('Say "hi" ✨')
+        habit['icon'], habit['icon_type'] = '🏃', 'emoji'
+        notion = fake_notion([habit])
+        notion.current_habit_datetime = datetime.fromisoformat(monday)
+        expected = utils.get_page_payload(notion.config.habit_tracker_db_id, notion.get_habit_properties(habit, 'cycle-id'), '🏃', 'emoji')
+        self.assertDictEqual(json.loads(notion.get_page_template(habit).render(monday, 'cycle-id')), expected)
+
+    def test_template_is_built_once_per_habit(self):
+        habit = daily_habit('Read')
+        notion = fake_notion([habit])
+        self.assertIs(notion.get_page_template(habit), notion.get_page_template(habit))
+        # a reloaded habit gets a new template
+        self.assertIsNot(notion.get_page_template(dict(habit)), notion.get_page_template(habit))
+
+    def test_default_properties_can_be_left_out(self):
+        habit = daily_habit('Read')
+        notion = fake_notion([habit], include_default_properties=False)
+        properties = json.loads(notion.get_page_template(habit).render(monday, 'cycle-id'))['properties']
+        self.assertSetEqual(set(properties), {'Name', 'Date', 'Cycle', 'Missed', 'Habit', 'Habit (Relation)'})
+
+class TestBenchmarks(unittest.TestCase):
+    def test_runs_offline(self):
+        results = benchmarks.run_benchmarks([10], [1, 7], repeat=1)
+        names = set(result['name'] for result in results)
+        self.assertSetEqual(names, {'startup', 'get_cycle_end_date', 'get_month+get_dates_til_next_cycle', 'payload_dicts', 'payload_templates', 'get_filtered_habits', 'plan_habits', 'create_habits_for_dates'})
+        self.assertTrue(all(result['best_seconds'] >= 0 for result in results))
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_quantiles(self):
+        histogram = Histogram([0.1, 1, 10])
+        for value in [0.05] * 90 + [0.5] * 8 + [20] * 2:
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.95), 1)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+
+    def test_bridge_records_each_endpoint(self):
+        clock = FakeClock()
+        bridge = fake_bridge([FakeResponse({'results': []}), FakeResponse({}, 429), FakeResponse({'id': 'page'}), FakeResponse({'object': 'error'}, 400)], limiter=utils.RateLimiter(3, 3, clock, clock.sleep))
+        bridge.query('db', {})
+        bridge.create_db_page('db', {}, None, None)
+        bridge.update_db_page({}, 'page')
+        report = bridge.metrics.report()
+        self.assertDictEqual(report['endpoints']['create']['status_codes'], {'429': 1, '200': 1})
+        self.assertEqual(report['endpoints']['create']['retries'], 1)
+        self.assertEqual(report['endpoints']['update']['error_rate'], 1)
+        self.assertEqual(report['endpoints']['query']['requests'], 1)
+        self.assertGreater(report['endpoints']['create']['bytes_sent'], 0)
+        self.assertGreater(report['endpoints']['query']['bytes_received'], 0)
+
+    def test_run_writes_reports(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        notion = fake_notion([daily_habit('Read')], result_pages([]), metrics_dir=directory.name, concurrency=1)
+        notion.get_current_cycle_id = lambda: 'cycle'
+        notion.create_habits_for_dates([monday])
+        notion.close()
+        with open(os.path.join(directory.name, 'notion_habits.json')) as fp:
+            report = json.load(fp)
+        self.assertEqual(report['endpoints']['create']['requests'], 1)
+        self.assertSetEqual(set(report['phases_seconds']), {'planning', 'cycle_resolution', 'page_creation'})
+        with open(os.path.join(directory.name, 'notion_habits.prom')) as fp:
+            prom = fp.read()
+        self.assertIn('notion_habits_requests_total{endpoint="create",status="200"} 1', prom)
+        self.assertIn('notion_habits_request_duration_seconds_bucket{endpoint="create",le="+Inf"} 1', prom)
+
+class TestRateLimiter(unittest.TestCase):
+    def test_sustained_rate(self):
+        clock = FakeClock()
+        limiter = utils.RateLimiter(2, 2, clock, clock.sleep)
+        waits = [limiter.acquire() for _ in range(6)]
+        # the burst goes out immediately, then one request every half second
+        self.assertListEqual(waits, [0, 0, 0.5, 0.5, 0.5, 0.5])
+
+    def test_pause_holds_back_callers(self):
+        clock = FakeClock()
+        limiter = utils.RateLimiter(2, 2, clock, clock.sleep)
+        limiter.pause(3)
+        self.assertEqual(limiter.acquire(), 3)
+
+    def test_shared_per_key(self):
+        self.assertIs(utils.RateLimiter.shared('secret_a'), utils.RateLimiter.shared('secret_a'))
+        self.assertIsNot(utils.RateLimiter.shared('secret_a'), utils.RateLimiter.shared('secret_b'))
+
+def fake_notion(habits=None, responses=None, **config) -> Notion:
+    notion = Notion(TEST_CONFIG_PATH)
+    notion.bridge = notion.generator.bridge = fake_bridge(responses, metrics=notion.metrics)
+    notion.config.habits = habits if habits is not None else []
+    notion.config.ledger_path = ':memory:'
+    # syncing habits saves the config, keep the tests from writing to the one every Notion is built from
+    notion.generator.config = {'habits_db': notion.config.habits_db}
+    notion.save_config = False
+    for key in config:
+        setattr(notion.config, key, config[key])
+    return notion
+
+def daily_habit(name):
+    return {'name': name, 'frequency': 'Daily', 'status': 'On', 'days': None, 'id': name + '-id', 'icon': None, 'icon_type': None}
+
+class SlowSession(FakeSession):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return super().request(method, url, data, timeout)
+
+class TestAsyncBridge(unittest.TestCase):
+    def test_in_flight_is_bounded(self):
+        bridge = fake_bridge()
+        bridge.session = SlowSession(0.02)
+        async def create_all():
+            async with utils.AsyncBridge(bridge, 3) as async_bridge:
+                return await asyncio.gather(*[async_bridge.create_db_page('db', {}, None, None) for _ in range(10)])
+        results = asyncio.run(create_all())
+        self.assertEqual(len(results), 10)
+        self.assertEqual(bridge.session.max_in_flight, 3)
+
+    def test_pages_use_cycle_of_their_date(self):
+        notion = fake_notion([daily_habit('Read'), daily_habit('Run')], concurrency=4)
+        resolved = []
+        def get_current_cycle_id():
+            resolved.append(notion.current_habit_datetime.strftime(YMD))
+            return 'cycle-' + resolved[-1]
+        notion.get_current_cycle_id = get_current_cycle_id
+        dates = [monday, tuesday, wednesday]
+        notion.create_habits_for_dates(dates)
+        self.assertListEqual(resolved, dates)
+        bodies = [json.loads(call[2]) for call in notion.bridge.session.calls]
+        self.assertEqual(len(bodies), 6)
+        for body in bodies:
+            self.assertEqual(body['properties']['Cycle']['relation'][0]['id'], 'cycle-' + body['properties']['Date']['date']['start'])
+
+class TestFleet(unittest.TestCase):
+    def test_config_paths_from_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['b.json', 'a.json', 'notes.txt']:
+                open(os.path.join(directory, name), 'w').close()
+            self.assertListEqual(fleet.get_config_paths(directory), [os.path.join(directory, 'a.json'), os.path.join(directory, 'b.json')])
+
+    def test_config_paths_from_manifest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = os.path.join(directory, 'fleet.json')
+            with open(manifest, 'w') as fp:
+                json.dump({'configs': ['tenants/alice.json']}, fp)
+            paths = fleet.get_config_paths(manifest)
+            self.assertListEqual(paths, [os.path.join(os.path.realpath(directory), 'tenants', 'alice.json')])
+            self.assertEqual(fleet.get_tenant(paths[0]), 'alice')
+
+    def test_failures_and_timeouts_are_isolated(self):
+        release = threading.Event()
+        def runner(path):
+            if path == 'broken.json':
+                raise SystemExit(1)
+            if path == 'slow.json':
+                release.wait(5)
+            return {'requests': 1}
+        results = fleet.run_fleet(['ok.json', 'broken.json', 'slow.json'], workers=3, timeout=0.2, runner=runner)
+        release.set()
+        self.assertListEqual([result['status'] for result in results], ['ok', 'failed', 'timed out'])
+        self.assertEqual(results[0]['stats'], {'requests': 1})
+        self.assertIn('SystemExit', results[1]['error'])
+        self.assertGreaterEqual(results[2]['seconds'], 0.2)
+
+    def test_unstarted_tenants_are_cancelled(self):
+        release = threading.Event()
+        results = fleet.run_fleet(['slow.json', 'waiting.json'], workers=1, timeout=0.1, runner=lambda path: release.wait(5))
+        release.set()
+        self.assertListEqual([result['status'] for result in results], ['timed out', 'cancelled'])
+
+    def test_config_gets_its_own_ledger(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'alice.json')
+            with open(path, 'w') as fp:
+                json.dump({'api_key': 'secret_alice'}, fp)
+            self.assertEqual(config.ConfigObject(path).ledger_path, os.path.join(directory, 'alice.ledger.sqlite3'))
+
+def tracker_page(habit_id, date):
+    return {'id': 'tracked-' + habit_id + '-' + date, 'properties': {'Date': {'date': {'start': date}}, 'Habit (Relation)': {'relation': [{'id': habit_id}]}}}
+
+class TestBackfill(unittest.TestCase):
+    @freeze_time(monday)
+    def test_backfills_cycles_and_missing_pages(self):
+        habits_query, cycles_query, tracker_query = result_pages([]) + result_pages([]) + result_pages([])
+        habits_query.body['results'] = [habit_page('Read')]
+        cycles_query.body['results'] = [cycle_page('old-active', '2023-03-01', '2023-03-15', 'Active')]
+        tracker_query.body['results'] = [tracker_page('Read-id', '2023-03-25')]
+        notion = fake_notion([], [habits_query, tracker_query, cycles_query], new_cycle_dates=[1, 15], concurrency=1)
+        notion.close = lambda: None
+        notion.backfill('2023-03-25', '2023-04-20')
+        calls = notion.bridge.session.calls[3:]
+        bodies = [json.loads(call[2]) for call in calls]
+        self.assertEqual(calls[0][1], utils.NOTION_BASE_URL + 'pages/old-active')
+        self.assertEqual(bodies[0]['properties']['Status']['select']['name'], 'Archive')
+        cycles = {body['properties']['Date Range']['date']['start']: (body['properties']['Date Range']['date']['end'], body['properties']['Status']['select']['name'], 'page-' + str(i + 4)) for i, body in enumerate(bodies) if 'Date Range' in body['properties']}
+        self.assertDictEqual({start: cycle[:2] for start, cycle in cycles.items()}, {
+            '2023-03-15': ('2023-04-01', 'Archive'),
+            '2023-04-01': ('2023-04-15', 'Active'),
+            '2023-04-15': ('2023-05-01', 'Upcoming'),
+        })
+        pages = [body for body in bodies if 'Date' in body['properties']]
+        self.assertListEqual([page['properties']['Date']['date']['start'] for page in pages], [date for date in notion.get_date_range('2023-03-26', '2023-04-20')])
+        for page in pages:
+            date = page['properties']['Date']['date']['start']
+            start = max(start for start in cycles if start <= date)
+            self.assertEqual(page['properties']['Cycle']['relation'][0]['id'], cycles[start][2])
+
+    def test_daily_runs_move_backfilled_cycles_forward(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ledger_path = os.path.join(directory, 'ledger.sqlite3')
+            def get_notion(date, *responses):
+                habits_query = result_pages([])[0]
+                habits_query.body['results'] = [habit_page('Read')]
+                # compaction goes by the real clock, which would forget every page of 2023
+                notion = fake_notion([], new_cycle_dates=[1, 15], ledger_path=ledger_path, ledger_retention_days=100000)
+                notion.bridge.session = EchoSession([habits_query] + list(responses))
+                notion.run_date = datetime.fromisoformat(date)
+                return notion
+
+            notion = get_notion(monday)
+            notion.backfill(monday, '2023-05-31')
+            cycles = [json.loads(call[2])['properties'] for call in notion.bridge.session.calls if call[0] == 'POST' and json.loads(call[2]).get('parent', {}).get('database_id') == 'cycles']
+            self.assertListEqual([(cycle['Date Range']['date']['start'], cycle['Status']['select']['name']) for cycle in cycles], [('2023-04-01', 'Active'), ('2023-04-15', 'Upcoming'), ('2023-05-01', 'Upcoming'), ('2023-05-15', 'Upcoming')])
+
+            starts = ['2023-04-01', '2023-04-15', '2023-05-01', '2023-05-15', '2023-06-01']
+            for i, date in enumerate(starts[1:4], 1):
+                cycles_query = result_pages([])[0]
+                cycles_query.body['results'] = [cycle_page(starts[i - 1], starts[i - 1], starts[i], 'Active')] + [cycle_page(start, start, end) for start, end in zip(starts[i:], starts[i + 1:])]
+                notion = get_notion(date, cycles_query)
+                notion.run()
+                calls = notion.bridge.session.calls
+                # the pages were all created by the backfill, only the cycles move
+                self.assertListEqual([call[1].endswith('/query') for call in calls if call[0] == 'POST'], [True, True])
+                self.assertDictEqual({call[1].split('/')[-1]: json.loads(call[2])['properties']['Status']['select']['name'] for call in calls if call[0] == 'PATCH'}, {starts[i - 1]: 'Archive', date: 'Active'})
+
+    def test_rejects_reversed_range(self):
+        notion = fake_notion()
+        with self.assertRaises(Exception):
+            notion.backfill('2024-03-10', '2024-01-01')
+        self.assertListEqual(notion.bridge.session.calls, [])
+
+    def test_zero_concurrency_still_creates_pages(self):
+        notion = fake_notion([daily_habit('Read')], concurrency=0)
+        asyncio.run(notion.create_habits_async(notion.plan_habits([monday]), {monday: 'cycle'}))
+        self.assertEqual(len(notion.bridge.session.calls), 1)
+
+    def test_cycle_periods_cross_the_year(self):
+        notion = fake_notion([], new_cycle_dates=[1, 15])
+        self.assertListEqual([(start, end) for start, end, _ in notion.get_cycle_periods('2023-12-20', '2024-01-15')], [('2023-12-15', '2024-01-01'), ('2024-01-01', '2024-01-15'), ('2024-01-15', '2024-02-01')])
+
+class TestAudit(unittest.TestCase):
+    def get_notion(self, responses) -> Notion:
+        habits_query, tracker_query = result_pages([]) + result_pages([])
+        habits_query.body['results'] = [habit_page('Read'), habit_page('Run')]
+        first, duplicate = tracker_page('Read-id', '2023-04-10'), tracker_page('Read-id', '2023-04-10')
+        first['created_time'], duplicate['id'], duplicate['created_time'] = '2023-04-10T00:00:00.000Z', 'dup', '2023-04-10T00:05:00.000Z'
+        tracker_query.body['results'] = [duplicate, first, tracker_page('Run-id', '2023-04-10'), tracker_page('Read-id', '2023-04-11'), tracker_page('Gone-id', '2023-04-11')]
+        notion = fake_notion([], [habits_query, tracker_query] + responses, new_cycle_dates=[1], concurrency=1)
+        notion.close = lambda: None
+        return notion
+
+    @freeze_time(monday)
+    def test_reports_duplicates_and_gaps(self):
+        notion = self.get_notion([])
+        report = notion.audit(monday, tuesday)
+        self.assertListEqual([(entry['habit'], entry['date'], entry['kept'], entry['extra']) for entry in report['duplicates']], [('Read', monday, tracker_page('Read-id', monday)['id'], ['dup'])])
+        self.assertListEqual([(entry['habit'], entry['date']) for entry in report['missing']], [('Run', tuesday)])
+        self.assertListEqual([(entry['habit_id'], entry['date']) for entry in report['unexpected']], [('Gone-id', tuesday)])
+        self.assertTrue(all(call[1].endswith('/query?filter_properties=Date&filter_properties=Habit+%28Relation%29') for call in notion.bridge.session.calls[1:]))
+
+    @freeze_time(monday)
+    def test_fix_archives_and_creates(self):
+        cycles_query = result_pages([])[0]
+        cycles_query.body['results'] = [cycle_page('april', '2023-04-01', '2023-05-01', 'Active')]
+        notion = self.get_notion([FakeResponse({'id': 'archived'}), cycles_query])
+        notion.audit(monday, tuesday, fix=True)
+        calls = notion.bridge.session.calls[2:]
+        self.assertEqual(calls[0][:2], ('PATCH', utils.NOTION_BASE_URL + 'pages/dup'))
+        self.assertDictEqual(json.loads(calls[0][2]), {'archived': True})
+        created = json.loads(calls[2][2])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(created['properties']['Habit (Relation)']['relation'][0]['id'], 'Run-id')
+        self.assertEqual(created['properties']['Date']['date']['start'], tuesday)
+        self.assertEqual(created['properties']['Cycle']['relation'][0]['id'], 'april')
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.checkpoint = os.path.join(self.dir.name, 'retention.checkpoint')
+        self.export = os.path.join(self.dir.name, 'export.jsonl')
+
+    def retain(self, responses) -> tuple[Notion, dict]:
+        notion = fake_notion(responses=responses, retention_path=self.checkpoint, concurrency=1)
+        notion.run_date = datetime.fromisoformat(monday)
+        return notion, notion.retain(30, export_path=self.export)
+
+    def test_exports_archives_and_resumes(self):
+        query = result_pages([])[0]
+        query.body['results'] = [tracker_page('Read-id', '2023-01-01'), tracker_page('Run-id', '2023-01-01')]
+        notion, report = self.retain([query, FakeResponse({}), FakeResponse({'object': 'error'}, 400)])
+        self.assertDictEqual(report, {'found': 2, 'exported': 2, 'archived': 1, 'failed': 1})
+        self.assertEqual(json.loads(notion.bridge.session.calls[0][2])['filter'], {'property': 'Date', 'date': {'before': '2023-03-11'}})
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        # the archived page may still show up in a query right after
+        notion, report = self.retain([query])
+        self.assertDictEqual(report, {'found': 1, 'exported': 0, 'archived': 1, 'failed': 0})
+        self.assertListEqual([call[0] for call in notion.bridge.session.calls], ['POST', 'PATCH'])
+        self.assertTrue(notion.bridge.session.calls[1][1].endswith('tracked-Run-id-2023-01-01'))
+        with open(self.export) as fp:
+            self.assertEqual(len(fp.readlines()), 2)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_interrupted_scan_resumes(self):
+        first, _ = result_pages(['x'], ['y'])
+        first.body['results'] = [tracker_page('Read-id', '2023-01-01')]
+        with self.assertRaises(Exception):
+            self.retain([first, FakeResponse({'object': 'error'}, 400)])
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        second = result_pages([])[0]
+        second.body['results'] = [tracker_page('Read-id', '2023-01-01'), tracker_page('Run-id', '2023-01-01')]
+        _, report = self.retain([second])
+        self.assertDictEqual(report, {'found': 2, 'exported': 1, 'archived': 2, 'failed': 0})
+        with open(self.export) as fp:
+            self.assertEqual(len(fp.readlines()), 2)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_archived_cycle_queries(self):
+        queries = retention.get_retention_queries(None, ['cycle-' + str(i) for i in range(retention.MAX_CYCLES_PER_QUERY + 1)])
+        self.assertListEqual([len(query['filter']['or']) for query in queries], [retention.MAX_CYCLES_PER_QUERY, 1])
+
+def checked_page(habit_id, date, state, cycle_id='cycle'):
+    page = tracker_page(habit_id, date)
+    page['properties'].update({
+        'Cycle': {'relation': [{'id': cycle_id}]},
+        'Progress': {'checkbox': state == analytics.PROGRESS},
+        'Neutral': {'checkbox': state == analytics.NEUTRAL},
+        'Missed': {'checkbox': state == analytics.MISSED},
+    })
+    return page
+
+class TestAnalytics(unittest.TestCase):
+    def test_streaks_and_rates(self):
+        history = analytics.History()
+        P, N, M = analytics.PROGRESS, analytics.NEUTRAL, analytics.MISSED
+        for i, state in enumerate([P, P, P, M, P, N, P, P, M]):
+            history.set('Read-id', '2023-04-0' + str(i + 1), state)
+        # the 9th is today and unchecked, so it doesn't break the streak yet
+        self.assertEqual(history.streaks('Read-id', '2023-04-09'), (3, 3))
+        self.assertEqual(history.streaks('Read-id', '2023-04-10'), (0, 3))
+        summary = history.summary('2023-04-09')['habits']['Read-id']
+        self.assertEqual((summary['progress'], summary['neutral'], summary['missed']), (6, 1, 1))
+        self.assertAlmostEqual(summary['completion_rate'], 6 / 7)
+
+    def test_earlier_pages_move_the_epoch(self):
+        history = analytics.History()
+        history.set('Read-id', '2023-04-10', analytics.PROGRESS, 'april')
+        history.set('Read-id', '2023-04-08', analytics.MISSED, 'april')
+        self.assertEqual(history.epoch, datetime.fromisoformat('2023-04-08'))
+        self.assertEqual(bytes(history.habits['Read-id']), bytes([analytics.MISSED, 0, analytics.PROGRESS]))
+        cycle = history.summary('2023-04-10')['cycles']['april']
+        self.assertEqual((cycle['start'], cycle['end'], cycle['completion_rate']), ('2023-04-08', '2023-04-10', 0.5))
+
+    @freeze_time(tuesday)
+    def test_incremental_sync_and_write_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = result_pages([])[0]
+            first.body['results'] = [checked_page('Read-id', monday, analytics.MISSED), checked_page('Read-id', tuesday, analytics.MISSED)]
+            notion = fake_notion([daily_habit('Read')], [first], analytics_path=os.path.join(directory, 'checkpoint'), analytics_write_back=True)
+            summary = notion.update_analytics()
+            self.assertEqual(summary['habits']['Read-id']['current_streak'], 0)
+            self.assertNotIn('filter', json.loads(notion.bridge.session.calls[0][2]))
+            self.assertEqual(len(notion.bridge.session.calls), 3)
+
+            edited = result_pages([])[0]
+            edited.body['results'] = [checked_page('Read-id', tuesday, analytics.PROGRESS)]
+            notion = fake_notion([daily_habit('Read')], [edited], analytics_path=os.path.join(directory, 'checkpoint'), analytics_write_back=True)
+            summary = notion.update_analytics()
+            self.assertEqual(summary['habits']['Read-id']['current_streak'], 1)
+            self.assertEqual(json.loads(notion.bridge.session.calls[0][2])['filter']['timestamp'], 'last_edited_time')
+            updates = {call[1]: json.loads(call[2])['properties'] for call in notion.bridge.session.calls[1:]}
+            self.assertEqual(updates[utils.NOTION_BASE_URL + 'pages/Read-id']['Current Streak']['number'], 1)
+            self.assertEqual(updates[utils.NOTION_BASE_URL + 'pages/cycle']['Completion Rate']['number'], 0.5)
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.state_path = os.path.join(self.dir.name, 'state.json')
+
+    def get_daemon(self, now, **configs) -> tuple[daemon.Daemon, list]:
+        fired = []
+        notions = {}
+        for path, values in configs.items():
+            notion = fake_notion([], **values)
+            notion.run = lambda keep_open, path=path, notion=notion: fired.append((path, notion.today().strftime(YMD)))
+            notions[path] = notion
+        clock = FakeClock()
+        clock.now = now
+        return daemon.Daemon(notions, self.state_path, clock, clock.sleep), fired
+
+    def test_fire_time_is_local_midnight(self):
+        self.assertEqual(daemon.get_fire_time(datetime(2023, 5, 1).date(), 'Asia/Tokyo'), datetime.fromisoformat('2023-04-30T15:00:00+00:00').timestamp())
+
+    def test_due_days_follow_frequency(self):
+        notion = fake_notion([], job_frequency='3', new_cycle_dates=[1, 15])
+        self.assertListEqual([day for day in range(1, 31) if daemon.is_due(notion.config, datetime(2023, 5, day).date())], [1, 15])
+        notion.config.job_frequency = '1'
+        self.assertTrue(daemon.is_due(notion.config, datetime.fromisoformat(monday).date()))
+        self.assertFalse(daemon.is_due(notion.config, datetime.fromisoformat(tuesday).date()))
+
+    def test_catches_up_then_fires_at_each_midnight(self):
+        now = datetime.fromisoformat('2023-05-03T10:00:00+00:00').timestamp()
+        with open(self.state_path, 'w') as fp:
+            json.dump({'tokyo.json': '2023-04-30', 'london.json': '2023-05-02'}, fp)
+        d, fired = self.get_daemon(now, **{'tokyo.json': {'timezone': 'Asia/Tokyo'}, 'london.json': {'timezone': 'Europe/London'}})
+        d.start()
+        d.run_due()
+        self.assertListEqual(fired, [('tokyo.json', '2023-05-01'), ('tokyo.json', '2023-05-02'), ('tokyo.json', '2023-05-03'), ('london.json', '2023-05-03')])
+        # tokyo's midnight comes first, 14:00 UTC
+        d.clock.now = datetime.fromisoformat('2023-05-03T15:00:00+00:00').timestamp()
+        d.run_due()
+        self.assertEqual(fired[-1], ('tokyo.json', '2023-05-04'))
+        self.assertEqual(len(fired), 5)
+        with open(self.state_path) as fp:
+            self.assertDictEqual(json.load(fp), {'tokyo.json': '2023-05-04', 'london.json': '2023-05-03'})
+
+    def test_failed_run_is_not_recorded(self):
+        d, _ = self.get_daemon(datetime.fromisoformat('2023-05-03T10:00:00+00:00').timestamp(), **{'a.json': {}})
+        def fail(keep_open):
+            raise SystemExit(0)
+        d.notions['a.json'].run = fail
+        d.start()
+        d.run_due()
+        self.assertNotIn('a.json', d.state)
+        self.assertEqual(len(d.heap), 1)
+
+    @freeze_time('2023-05-01 20:00:00')
+    def test_today_uses_config_timezone(self):
+        notion = fake_notion([], timezone='Asia/Tokyo')
+        self.assertEqual(notion.today().strftime(YMD), '2023-05-02')
+        notion.run_date = datetime.fromisoformat(monday)
+        self.assertEqual(notion.today().strftime(YMD), monday)
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def busy(self):
+        notion = fake_notion([daily_habit(str(i)) for i in range(50)], concurrency=1)
+        notion.get_current_cycle_id = lambda: 'cycle'
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            notion.templates = {}
+            notion.create_habits_for_dates([monday, tuesday])
+
+    def test_full(self):
+        with profiling.Profiler(self.dir.name, profiling.FULL, interval=0.001) as profiler:
+            self.busy()
+        prefix = os.path.join(self.dir.name, os.listdir(self.dir.name)[0].split('.')[0])
+        for suffix in ['.pstats', '.txt', '.allocations.txt', '.collapsed']:
+            self.assertTrue(os.path.getsize(prefix + suffix), suffix)
+        with open(prefix + '.txt') as fp:
+            self.assertIn('create_habits_for_dates', fp.read())
+        self.assertGreater(profiler.sampler.samples, 0)
+
+    def test_sample(self):
+        with profiling.Profiler(self.dir.name, profiling.SAMPLE, interval=0.001):
+            self.busy()
+        self.assertListEqual(sorted(os.path.splitext(name)[1] for name in os.listdir(self.dir.name)), ['.collapsed', '.txt'])
+        with open(os.path.join(self.dir.name, next(name for name in os.listdir(self.dir.name) if name.endswith('.collapsed')))) as fp:
+            stacks = fp.read().splitlines()
+        self.assertTrue(any(stack.startswith('MainThread;') and 'notion.py:create_habits_for_dates' in stack for stack in stacks))
+        self.assertTrue(all(stack.rsplit(' ', 1)[1].isdigit() for stack in stacks))
+
+    def test_rate(self):
+        self.assertTrue(profiling.sampled(1))
+        self.assertFalse(profiling.sampled(0))
+
+# what `import notion` may cost a cron launch. measured in a fresh interpreter, so none of the test imports count
+IMPORT_BUDGET_SECONDS = 0.25
+
+class TestStartup(unittest.TestCase):
+    def test_import_stays_lean(self):
+        script = 'import sys, time; start = time.perf_counter(); import notion; print(time.perf_counter() - start); print(",".join(sorted(sys.modules)))'
+        seconds, modules = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.realpath(__file__))).stdout.splitlines()
+        for module in ['requests', 'holidays', 'asyncio', 'concurrent.futures']:
+            self.assertNotIn(module, modules.split(','))
+        self.assertLess(float(seconds), IMPORT_BUDGET_SECONDS)
+
+    def test_config_is_parsed_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'config.json')
+            with open(path, 'w') as fp:
+                json.dump({'api_key': 'secret_test', 'habits': [daily_habit('Read')]}, fp)
+            notion = Notion(path)
+            self.assertIs(notion.generator.config, notion.config.config)
+            self.assertIs(notion.generator.bridge, notion.bridge)
+
+    def test_snapshot_follows_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'config.json')
+            config.save_config(path, {'api_key': 'secret_test', 'new_cycle_dates': [1]})
+            self.assertEqual(config.load_config(path, True)['new_cycle_dates'], [1])
+            self.assertTrue(os.path.exists(path + config.SNAPSHOT_SUFFIX))
+            # reads come from the snapshot while the config is untouched
+            with open(path + config.SNAPSHOT_SUFFIX, 'rb') as fp:
+                key, snapshot = marshal.load(fp)
+            snapshot['new_cycle_dates'] = [2]
+            with open(path + config.SNAPSHOT_SUFFIX, 'wb') as fp:
+                marshal.dump([key, snapshot], fp)
+            self.assertEqual(config.load_config(path, True)['new_cycle_dates'], [2])
+            with open(path, 'w') as fp:
+                json.dump({'api_key': 'secret_test', 'new_cycle_dates': [1, 15]}, fp)
+            os.utime(path, ns=(key[0] + 10 ** 9, key[0] + 10 ** 9))
+            self.assertEqual(config.load_config(path, True)['new_cycle_dates'], [1, 15])
+
 def test_valid_dates(tester, valid, habits):
     expected = [habit for habit in tester.habits if habit['name'] in valid]
     invalid = [habit for habit in tester.habits if habit['name'] not in valid]
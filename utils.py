@@ -1,7 +1,27 @@
-
 NOTION_BASE_URL = 'https://api.notion.com/v1/'
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_CONCURRENCY = 3
+# notion allows an average of 3 requests per second per integration
+DEFAULT_REQUESTS_PER_SECOND = 3
+DEFAULT_BURST = 3
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+MAX_PAGE_SIZE = 100
+# notion rounds last_edited_time down to the minute, so incremental syncs look back a little past the last one
+SYNC_OVERLAP_MINUTES = 2
 import json
-import requests
+import random
+import threading
+import time
+from typing import Generator
+from urllib.parse import urlencode
+from metrics import Metrics
+# requests, asyncio and concurrent.futures are imported where they're first needed. together they're most of the
+# job's import time, and a run with nothing left to create never sends a request
 
 def get_icon(obj) -> str | None:
     if not obj:
@@ -20,52 +40,329 @@ def get_icon_type(obj) -> str | None:
     return None
 
 
+class RateLimiter:
+    '''
+    token bucket refilled at rate tokens per second, holding at most burst tokens. callers that find the bucket empty
+    reserve the next token and sleep until it's theirs, so waiting requests go out in arrival order at exactly the
+    sustained rate. one limiter is shared by every bridge using the same integration token (see shared)
+    '''
+    limiters = {}
+    limiters_lock = threading.Lock()
+
+    def __init__(self, rate=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, key, rate=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST):
+        '''
+        the limiter for an integration token, created on first use. limits are per integration, not per bridge
+        '''
+        with cls.limiters_lock:
+            if key not in cls.limiters:
+                cls.limiters[key] = cls(rate, burst)
+            return cls.limiters[key]
+
+    def acquire(self) -> float:
+        '''
+        takes one token, sleeping until it's available. returns the seconds spent waiting
+        '''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.blocked_until - now, 0)
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        '''
+        holds back every caller of this limiter for the given seconds, used when notion tells us to back off
+        '''
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+
+def get_page_payload(db_id, properties, icon, icon_type) -> dict:
+    payload = {
+        'parent': {
+            'type': 'database_id',
+            'database_id': db_id,
+        },
+        'properties': properties,
+    }
+    if icon:
+        payload['icon'] = {
+            'type': icon_type,
+            icon_type: icon,
+        }
+    return payload
+
+def get_retry_delay(response, attempt) -> float:
+    '''
+    seconds to wait before retrying. Retry-After is respected when notion sends it, with a little jitter
+    so that concurrent callers don't all come back at once; otherwise full jitter exponential backoff
+    '''
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, BACKOFF_BASE)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def never_sent(e) -> bool:
+    '''
+    whether a failed request never reached notion: the connection couldn't be made, so not a byte of it was sent
+    '''
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
 class Bridge:
-    def __init__(self, api_key):
+    '''
+    thin client over the notion API. all calls share one pooled keep-alive session so a run
+    only pays for the TCP/TLS handshake once per pooled connection instead of once per request.
+    the session is opened on the first request
+    '''
+    def __init__(self, api_key, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, limiter: RateLimiter = None, max_retries=MAX_RETRIES, metrics: Metrics = None):
         self.api_key = api_key
         self.headers = self.get_headers()
-        
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = limiter or RateLimiter.shared(api_key)
+        self.max_retries = max_retries
+        self.metrics = metrics or Metrics()
+        self.pool_size = pool_size
+        self.session = None
+        self.adapter = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                self.session = requests.Session()
+                self.session.headers.update(self.headers)
+                self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                self.session.mount(NOTION_BASE_URL, self.adapter)
+            return self.session
+
+    def record(self, path, header: dict = None):
+        '''
+        from now on every response is also written to a cassette at path (see cassette.py)
+        '''
+        import cassette
+        self.session = cassette.RecordingSession(self.session or self.get_session(), path, header)
+
+    def replay(self, path, latency=0) -> dict:
+        '''
+        from now on requests are answered from the cassette at path instead of notion, with latency seconds of
+        simulated network time each. returns the cassette's header
+        '''
+        import cassette
+        self.session = cassette.ReplaySession(path, latency)
+        # there's no api to protect, replays go as fast as they're asked to
+        self.limiter = RateLimiter(10 ** 9, 10 ** 9)
+        return self.session.header
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
     def get_headers(self):
         return {
             'Notion-Version': '2022-06-28',
             'Content-Type': 'application/json',
             'Authorization': 'Bearer ' + self.api_key
         }
-        
-    def query(self, db_id, body):
-        r = requests.post(NOTION_BASE_URL + 'databases/' + db_id + '/query', headers=self.headers, data=json.dumps(body))
+
+    def send(self, method, url, body, endpoint, idempotent=True):
+        '''
+        sends a request through the rate limiter, retrying rate limited, failed and timed out requests with backoff.
+        a request that isn't idempotent (creating a page) may already have been carried out when it times out or fails
+        on notion's side, so it's only retried when rate limited or when it never reached notion.
+        body can be passed already encoded as bytes. endpoint names the call in metrics (query, create or update)
+        '''
+        import requests
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        session = self.session or self.get_session()
+        attempt = 0
+        while 1:
+            self.metrics.observe_throttle(self.limiter.acquire())
+            start = time.monotonic()
+            response = None
+            try:
+                response = session.request(method, url, data=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries or not (idempotent or never_sent(e)):
+                    raise e
+            finally:
+                self.metrics.observe_request(endpoint, response.status_code if response is not None else 'error', time.monotonic() - start, len(data), len(response.content) if response is not None else 0)
+            if response is not None and (response.status_code not in RETRY_STATUS_CODES or not (idempotent or response.status_code == 429)):
+                return response
+            if attempt == self.max_retries:
+                if response.status_code == 429:
+                    raise Exception('UTIL: still rate limited after ' + str(self.max_retries) + ' retries of ' + method + ' ' + url)
+                return response
+            delay = get_retry_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                # everyone sharing this integration's limiter has to back off, not just this request
+                self.limiter.pause(delay)
+            else:
+                self.limiter.sleep(delay)
+                self.metrics.observe_throttle(delay)
+            self.metrics.observe_retry(endpoint)
+            attempt += 1
+
+    def connections_opened(self) -> int:
+        if not self.adapter:
+            return 0
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def stats(self) -> dict:
+        '''
+        connection usage for this bridge so far. every request that didn't need a new connection reused a pooled one
+        '''
+        opened = self.connections_opened()
+        requests_sent = self.metrics.total_requests()
+        return {
+            'requests': requests_sent,
+            'connections_opened': opened,
+            'connections_reused': max(requests_sent - opened, 0),
+            'retries': self.metrics.total_retries(),
+            'throttled_seconds': round(self.metrics.throttled_seconds, 3),
+            'network_seconds': round(self.metrics.network_seconds, 3),
+        }
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+    def query(self, db_id, body, filter_properties=None):
+        url = NOTION_BASE_URL + 'databases/' + db_id + '/query'
+        if filter_properties:
+            url += '?' + urlencode([('filter_properties', prop) for prop in filter_properties])
+        r = self.send('POST', url, body, 'query')
         if r.status_code != 200:
-            print('UTIL: error querying URL ' + NOTION_BASE_URL + 'databases/' + db_id + '/query' + ': ')
+            print('UTIL: error querying URL ' + url + ': ')
             print('received status code: ' + str(r.status_code))
             raise Exception(r.json())
         return r
-    
+
+    def stream(self, db_id, body, page_size=MAX_PAGE_SIZE, filter_properties=None, prefetch=False) -> Generator[dict, None, None]:
+        '''
+        lazily yields every result of a database query, following next_cursor one page at a time as the caller consumes them.
+        filter_properties limits the properties returned for each page. with prefetch, the next page is requested
+        in the background while the caller works through the current one
+        '''
+        def fetch(cursor):
+            page_body = dict(body, page_size=page_size)
+            if cursor:
+                page_body['start_cursor'] = cursor
+            return self.query(db_id, page_body, filter_properties).json()
+
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch') if prefetch else None
+        try:
+            page = fetch(None)
+            while 1:
+                has_more = page.get('has_more') and page.get('next_cursor')
+                next_page = executor.submit(fetch, page['next_cursor']) if executor and has_more else None
+                yield from page.get('results', [])
+                if not has_more:
+                    return
+                page = next_page.result() if next_page else fetch(page['next_cursor'])
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
+
     def create_db_page(self, db_id, properties, icon, icon_type):
-        payload = {
-            'parent': {
-                'type': 'database_id',
-                'database_id': db_id,
-            },
-            'properties': properties,
-        }
-        if icon:
-            payload['icon'] = {
-                'type': icon_type,
-                icon_type: icon,
-            }
-            
-        response = requests.post(NOTION_BASE_URL + 'pages', headers=self.headers, data=json.dumps(payload))
+        return self.create_page_from_body(get_page_payload(db_id, properties, icon, icon_type))
+
+    def create_page_from_body(self, body):
+        '''
+        creates a page from a complete request body, either a payload dict or its already encoded bytes
+        '''
+        response = self.send('POST', NOTION_BASE_URL + 'pages', body, 'create', idempotent=False)
         if response.status_code != 200:
             print('UTIL: error encountered creating page')
             print(response.json())
         return response.json()
-    
+
     def update_db_page(self, properties_to_update, id):
         payload = {
             'properties': properties_to_update,
         }
-        response = requests.patch(NOTION_BASE_URL + 'pages/' + id, headers=self.headers, data=json.dumps(payload))
+        response = self.send('PATCH', NOTION_BASE_URL + 'pages/' + id, payload, 'update')
         if response.status_code != 200:
             print('UTIL: error encountered updating page')
             print(response.json())
-        return response
\ No newline at end of file
+        return response
+
+    def archive_page(self, id):
+        response = self.send('PATCH', NOTION_BASE_URL + 'pages/' + id, {'archived': True}, 'archive')
+        if response.status_code != 200:
+            print('UTIL: error encountered archiving page')
+            print(response.json())
+        return response
+
+
+class AsyncBridge:
+    '''
+    asyncio counterpart to Bridge. requests has no asyncio support, so each call runs on a worker thread
+    over the wrapped bridge's pooled session, with at most max_in_flight calls outstanding at once
+    '''
+    def __init__(self, bridge: Bridge, max_in_flight=DEFAULT_CONCURRENCY):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self.bridge = bridge
+        self.max_in_flight = max_in_flight
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='bridge')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+    async def call(self, fn, *args):
+        import asyncio
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def query(self, db_id, body):
+        return await self.call(self.bridge.query, db_id, body)
+
+    async def create_db_page(self, db_id, properties, icon, icon_type):
+        return await self.call(self.bridge.create_db_page, db_id, properties, icon, icon_type)
+
+    async def update_db_page(self, properties_to_update, id):
+        return await self.call(self.bridge.update_db_page, properties_to_update, id)
+
+    async def archive_page(self, id):
+        return await self.call(self.bridge.archive_page, id)
+
+    def close(self):
+        '''
+        only shuts down the worker threads, the wrapped bridge stays open for its owner to close
+        '''
+        self.executor.shutdown(wait=True)
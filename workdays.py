@@ -0,0 +1,60 @@
+import json
+import os
+YMD = '%Y-%m-%d'
+CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.cache')
+
+def compute_holidays(country, subdiv, year) -> list[str]:
+    '''
+    every holiday in year as YMD strings. holidays is a heavy import, so it's only loaded here, when a year isn't cached yet
+    '''
+    import holidays
+    return sorted(date.strftime(YMD) for date in holidays.country_holidays(country, subdiv=subdiv, years=year))
+
+
+class HolidayCalendar:
+    '''
+    holiday dates for a country (and optionally a subdivision like a state), computed once per year and cached on disk.
+    supports "date in calendar" for datetimes and YMD strings
+    '''
+    def __init__(self, country='US', subdiv=None, cache_dir=CACHE_DIR):
+        self.country = country
+        self.subdiv = subdiv
+        self.cache_dir = cache_dir
+        self.years: dict[int, set[str]] = {}
+
+    def __contains__(self, date):
+        if isinstance(date, str):
+            return date in self.get_year(int(date[0:4]))
+        return date.strftime(YMD) in self.get_year(date.year)
+
+    def get_cache_path(self, year) -> str:
+        return os.path.join(self.cache_dir, '-'.join(['holidays', self.country] + ([self.subdiv] if self.subdiv else []) + [str(year)]) + '.json')
+
+    def get_year(self, year) -> set[str]:
+        if year not in self.years:
+            self.years[year] = set(self.load_year(year))
+        return self.years[year]
+
+    def load_year(self, year) -> list[str]:
+        path = self.get_cache_path(year)
+        try:
+            with open(path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            pass
+        days = compute_holidays(self.country, self.subdiv, year)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path, 'w') as fp:
+                json.dump(days, fp)
+        except OSError as e:
+            # a read only checkout shouldn't stop the job, we just won't have a cache next time
+            print('could not cache holidays at ' + path + ': ' + str(e))
+        return days
+
+    def prepare(self, dates):
+        '''
+        loads every year the dates fall in up front so lookups during the run never hit the disk
+        '''
+        for year in set(date.year for date in dates):
+            self.get_year(year)